@@ -0,0 +1,122 @@
+# benchmarks/bench_chunker.py - скорость и корректность разбивки сообщений
+#
+# Запуск из папки бота:  python benchmarks/bench_chunker.py
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.chunker import MAX_MESSAGE_LENGTH, split_message, StreamChunker  # noqa: E402
+from benchmarks.samples import SIZES, model_output  # noqa: E402
+
+
+def legacy_split_message(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
+    """Прежняя реализация split_message (для сравнения)"""
+    if len(text) <= max_length:
+        return [text]
+    
+    chunks = []
+    current_chunk = ""
+    
+    paragraphs = text.split('\n\n')
+    
+    for paragraph in paragraphs:
+        if len(paragraph) > max_length:
+            sentences = re.split(r'(?<=[.!?])\s+', paragraph)
+            
+            for sentence in sentences:
+                if len(sentence) > max_length:
+                    for i in range(0, len(sentence), max_length - 100):
+                        chunk = sentence[i:i + max_length - 100]
+                        chunks.append(chunk)
+                    continue
+                
+                if len(current_chunk) + len(sentence) + 1 <= max_length:
+                    current_chunk += sentence + " "
+                else:
+                    if current_chunk:
+                        chunks.append(current_chunk.strip())
+                    current_chunk = sentence + " "
+        
+        else:
+            if len(current_chunk) + len(paragraph) + 2 <= max_length:
+                current_chunk += paragraph + "\n\n"
+            else:
+                if current_chunk:
+                    chunks.append(current_chunk.strip())
+                current_chunk = paragraph + "\n\n"
+    
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    
+    return chunks
+
+
+def stream_split(text: str, piece: int = 40) -> list:
+    """Разбивка потокового ответа, пришедшего кусками по piece символов"""
+    chunker = StreamChunker()
+    chunks = []
+    for i in range(0, len(text), piece):
+        chunks.extend(chunker.feed(text[i:i + piece]))
+    chunks.extend(chunker.finish())
+    return chunks
+
+
+def broken(chunks: list, max_length: int = MAX_MESSAGE_LENGTH) -> dict:
+    """Нарушения: слишком длинные части и части с незакрытым блоком кода"""
+    return {
+        "too_long": sum(len(chunk) > max_length for chunk in chunks),
+        "open_fence": sum(chunk.count("```") % 2 for chunk in chunks),
+    }
+
+
+def check_fences():
+    """Строки с ``` посреди текста — не блок кода; блок кода длиннее части открывается заново"""
+    inline = "Поставь пакет:\n```pip install foo``` — и готово.\n" + "слово " * 900 + "\n\nконец"
+    long_line = "hi\n\n```" + "x" * 5600 + "```\n\nend"
+    block = "Код:\n```python\n" + "print('строка кода')\n" * 400 + "```\nконец"
+    
+    for label, func in (("split", split_message), ("stream", stream_split)):
+        chunks = func(inline)
+        assert len(chunks) == 2, (label, len(chunks))
+        assert not chunks[0].endswith("```"), label  # лишнего закрытия блока нет
+        assert "pip install" not in chunks[1], label  # строка не повторяется в следующей части
+        
+        chunks = func(long_line)
+        assert all(len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks), label
+        assert sum(map(len, chunks)) <= len(long_line), label
+        
+        chunks = func(block)
+        assert len(chunks) > 1 and not broken(chunks)["too_long"] and not broken(chunks)["open_fence"], label
+        assert all(chunk.startswith("```python\n") for chunk in chunks[1:]), label
+    
+    print("✅ проверки блоков кода пройдены")
+
+
+def best_of(func, text: str, repeat: int = 5) -> float:
+    """Лучшее время одного вызова, мс"""
+    number = max(1, 200_000 // len(text))
+    return min(timeit.repeat(lambda: func(text), number=number, repeat=repeat)) / number * 1000
+
+
+def main():
+    check_fences()
+    
+    print(f"{'размер':>8} {'функция':>10} {'мс':>9} {'частей':>7} {'длинных':>8} {'незакрытых ```':>15}")
+    
+    for name, size in SIZES.items():
+        text = model_output(size)
+        
+        for label, func in (("legacy", legacy_split_message), ("split", split_message), ("stream", stream_split)):
+            chunks = func(text)
+            problems = broken(chunks)
+            print(
+                f"{name:>8} {label:>10} {best_of(func, text):>9.3f} {len(chunks):>7} "
+                f"{problems['too_long']:>8} {problems['open_fence']:>15}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# benchmarks/bench_formatter.py - скорость форматирования ответа для Telegram
+#
+# Запуск из папки бота:  python benchmarks/bench_formatter.py
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.formatter import format_code, escape_markdown  # noqa: E402
+from benchmarks.samples import model_output  # noqa: E402
+
+SIZES = {
+    "4k": 4_000,
+    "16k": 16_000,
+    "100k": 100_000,
+}
+
+
+def legacy_format_code(text: str) -> str:
+    """Прежний format_code: регулярное выражение, переписывающее блоки кода сами в себя"""
+    pattern = r'```(\w+)?\n(.*?)```'
+    
+    def replace_code_block(match):
+        language = match.group(1) or ''
+        code = match.group(2)
+        return f'```{language}\n{code}```'
+    
+    return re.sub(pattern, replace_code_block, text, flags=re.DOTALL)
+
+
+def legacy_escape_markdown(text: str) -> str:
+    """Прежний escape_markdown: 18 проходов str.replace"""
+    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+    
+    for char in special_chars:
+        text = text.replace(char, f'\\{char}')
+    
+    return text
+
+
+def best_of(func, text: str, repeat: int = 5) -> float:
+    """Лучшее время одного вызова, мс"""
+    number = max(1, 400_000 // len(text))
+    return min(timeit.repeat(lambda: func(text), number=number, repeat=repeat)) / number * 1000
+
+
+def main():
+    functions = (
+        ("legacy format_code", legacy_format_code),
+        ("format_code (MarkdownV2)", format_code),
+        ("legacy escape_markdown", legacy_escape_markdown),
+        ("escape_markdown", escape_markdown),
+    )
+    
+    print(f"{'размер':>8} {'функция':>26} {'мс':>9} {'МБ/с':>8}")
+    
+    for name, size in SIZES.items():
+        text = model_output(size)
+        
+        for label, func in functions:
+            elapsed = best_of(func, text)
+            print(f"{name:>8} {label:>26} {elapsed:>9.3f} {len(text) / elapsed / 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
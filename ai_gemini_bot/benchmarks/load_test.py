@@ -0,0 +1,340 @@
+# benchmarks/load_test.py - нагрузочный тест BotHandlers без сети
+#
+# Telegram заменён записывающей заглушкой, Gemini — локальной моделью
+# с настраиваемой задержкой; база — временный файл SQLite.
+#
+# Запуск из папки бота:  python benchmarks/load_test.py --users 2000 --messages 5
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import handlers as handlers_module  # noqa: E402
+from handlers import BotHandlers  # noqa: E402
+from rate_limiter import AdaptiveRateLimiter  # noqa: E402
+from scheduler import PriorityScheduler  # noqa: E402
+from telegram.error import BadRequest  # noqa: E402
+from utils.formatter import markdown_v2_error  # noqa: E402
+from benchmarks.samples import model_output  # noqa: E402
+
+QUESTIONS = [
+    "привет", "как дела?", "напиши функцию сортировки на python",
+    "объясни, что такое замыкание", "переведи на английский: доброе утро",
+    "сколько будет 17 * 23?", "дай 5 идей для выходных", "что такое SQLite WAL?",
+]
+
+
+# ========================================
+# ЗАГЛУШКА TELEGRAM
+# ========================================
+
+class FakeTelegram:
+    """
+    Записывает всё, что бот отправил, и проверяет сообщения как Telegram
+    
+    MarkdownV2 с ошибкой разметки и слишком длинные сообщения отклоняются
+    с BadRequest — так тест ловит и ошибки форматирования.
+    """
+    
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent = 0
+        self.edited = 0
+        self.actions = 0
+        self.chars = 0
+        self.rejected = 0
+    
+    async def deliver(self, text: str, parse_mode=None, edit: bool = False):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        if len(text) > 4096 or (parse_mode == 'MarkdownV2' and markdown_v2_error(text)):
+            self.rejected += 1
+            raise BadRequest("Can't parse entities" if len(text) <= 4096 else "Message is too long")
+        
+        if edit:
+            self.edited += 1
+        else:
+            self.sent += 1
+        self.chars += len(text)
+
+
+class FakeSentMessage:
+    """Сообщение бота: его можно редактировать (потоковый ответ)"""
+    
+    def __init__(self, telegram: FakeTelegram):
+        self.telegram = telegram
+    
+    async def edit_text(self, text: str, parse_mode=None, **kwargs):
+        await self.telegram.deliver(text, parse_mode, edit=True)
+        return self
+
+
+class FakeChat:
+    def __init__(self, telegram: FakeTelegram):
+        self.telegram = telegram
+    
+    async def send_action(self, action: str):
+        self.telegram.actions += 1
+
+
+class FakeMessage:
+    """Входящее сообщение пользователя (то, что обработчики читают и на что отвечают)"""
+    
+    def __init__(self, telegram: FakeTelegram, text: str = ""):
+        self.telegram = telegram
+        self.text = text
+        self.chat = FakeChat(telegram)
+    
+    async def reply_text(self, text: str, parse_mode=None, **kwargs):
+        await self.telegram.deliver(text, parse_mode)
+        return FakeSentMessage(self.telegram)
+    
+    async def reply_document(self, document, **kwargs):
+        self.telegram.sent += 1
+
+
+class FakeCallbackQuery:
+    def __init__(self, telegram: FakeTelegram, data: str):
+        self.data = data
+        self.message = FakeMessage(telegram)
+    
+    async def answer(self):
+        pass
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f"load_{user_id}"
+
+
+class FakeUpdate:
+    """Синтетический Update: то подмножество полей, которое используют BotHandlers"""
+    
+    def __init__(self, telegram: FakeTelegram, user_id: int, text: str = "", callback_data: str = None):
+        self.effective_user = FakeUser(user_id)
+        self.callback_query = FakeCallbackQuery(telegram, callback_data) if callback_data else None
+        self.message = FakeMessage(telegram, text) if callback_data is None else None
+        self.effective_message = self.message or self.callback_query.message
+        self.effective_chat = self.effective_message.chat
+
+
+class FakeContext:
+    def __init__(self, args: list = None):
+        self.args = args or []
+
+
+# ========================================
+# ЗАГЛУШКА GEMINI
+# ========================================
+
+class FakeUsage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class FakeResponse:
+    """Ответ generate_content_async: целиком или потоком кусков"""
+    
+    def __init__(self, text: str, prompt_chars: int, pieces: int = 1, piece_delay: float = 0.0):
+        self.text = text
+        self.usage_metadata = FakeUsage(prompt_chars // 3 + 1, len(text) // 3 + 1)
+        self._pieces = pieces
+        self._piece_delay = piece_delay
+    
+    async def __aiter__(self):
+        step = max(1, len(self.text) // self._pieces)
+        for start in range(0, len(self.text), step):
+            if self._piece_delay:
+                await asyncio.sleep(self._piece_delay)
+            yield FakeResponse(self.text[start:start + step], 0)
+
+
+class FakeModel:
+    """Вместо genai.GenerativeModel: задержка ~ latency (± jitter), ответ из benchmarks.samples"""
+    
+    def __init__(self, latency: float, jitter: float, response_size: int, pieces: int, seed: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.response_size = response_size
+        self.pieces = pieces
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self._responses = [model_output(response_size, seed + i) for i in range(16)]
+    
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        self.calls += 1
+        delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+        text = self.rng.choice(self._responses)
+        prompt_chars = len(str(contents))
+        
+        if stream:
+            # Первый кусок — через половину задержки, остальное — равномерно
+            await asyncio.sleep(delay / 2)
+            return FakeResponse(text, prompt_chars, self.pieces, delay / 2 / self.pieces)
+        
+        await asyncio.sleep(delay)
+        return FakeResponse(text, prompt_chars)
+
+
+# ========================================
+# СЦЕНАРИЙ
+# ========================================
+
+class LoadTest:
+    """Пользователи параллельно: /start, сообщения, кнопки, промокоды"""
+    
+    def __init__(self, args, db_path: str):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.telegram = FakeTelegram(args.telegram_latency)
+        
+        self.handlers = BotHandlers(db_path=db_path)
+        gemini = self.handlers.gemini
+        model = FakeModel(args.gemini_latency, args.gemini_jitter, args.response_size, args.pieces, args.seed)
+        gemini.model = gemini._persona_model = gemini.plain_model = model
+        self.model = model
+        
+        # Лимиты настоящего API здесь не нужны — иначе тест измерит RPM
+        gemini.limiter = AdaptiveRateLimiter(rpm=1e9, tpm=1e12)
+        gemini.scheduler = PriorityScheduler(args.gemini_concurrency)
+        
+        self.latencies = {}  # обработчик -> [секунды]
+        self.errors = 0
+        self.promo_codes = []
+    
+    def prepare(self):
+        """Промокоды для части пользователей"""
+        for index in range(self.args.users // 10 + 1):
+            code = f"LOAD-{index:05d}"
+            self.handlers.db.create_promocode(code, 'premium', days=7, uses=1)
+            self.promo_codes.append(code)
+    
+    async def call(self, name: str, handler, update, context=None):
+        start = time.perf_counter()
+        try:
+            await handler(update, context or FakeContext())
+        except Exception as e:
+            self.errors += 1
+            logging.getLogger(__name__).error(f"❌ {name}: {e}")
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+    
+    async def user(self, user_id: int, rng: random.Random):
+        """Один пользователь: действия по очереди, как в настоящем чате"""
+        await asyncio.sleep(rng.uniform(0, self.args.ramp))
+        telegram = self.telegram
+        h = self.handlers
+        
+        await self.call("start", h.start, FakeUpdate(telegram, user_id, "/start"))
+        
+        if rng.random() < 0.1 and self.promo_codes:
+            code = self.promo_codes.pop()
+            await self.call("promo", h.promo_activate, FakeUpdate(telegram, user_id, f"/promo {code}"), FakeContext([code]))
+        
+        for _ in range(self.args.messages):
+            await asyncio.sleep(rng.uniform(0, self.args.think_time))
+            
+            if rng.random() < 0.1:
+                data = rng.choice(("stats", "help", "upgrade"))
+                await self.call("button", h.button_callback, FakeUpdate(telegram, user_id, callback_data=data))
+            else:
+                await self.call("message", h.handle_message, FakeUpdate(telegram, user_id, rng.choice(QUESTIONS)))
+    
+    async def run(self) -> float:
+        first_id = 10_000_000
+        tasks = [
+            self.user(first_id + index, random.Random(self.args.seed + index))
+            for index in range(self.args.users)
+        ]
+        
+        start = time.perf_counter()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        
+        # Дождаться фоновых задач (сжатие истории) и дописать очередь записи
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        self.handlers.db.flush()
+        return elapsed
+
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль по отсортированным значениям (ближайший ранг)"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(q * len(values))) - 1))
+    return values[index]
+
+
+def db_size(path: str) -> int:
+    """Размер базы вместе с журналом WAL"""
+    return sum(os.path.getsize(name) for name in (path, path + "-wal") if os.path.exists(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест BotHandlers (без сети)")
+    parser.add_argument("--users", type=int, default=1000, help="пользователей одновременно")
+    parser.add_argument("--messages", type=int, default=5, help="действий на пользователя после /start")
+    parser.add_argument("--ramp", type=float, default=2.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--think-time", type=float, default=0.5, help="пауза пользователя между сообщениями, до N сек")
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="средняя задержка ответа Gemini, сек")
+    parser.add_argument("--gemini-jitter", type=float, default=0.2, help="разброс задержки Gemini, ± сек")
+    parser.add_argument("--gemini-concurrency", type=int, default=64, help="одновременных запросов к Gemini")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка каждого запроса к Telegram, сек")
+    parser.add_argument("--response-size", type=int, default=1500, help="длина ответа Gemini, символов")
+    parser.add_argument("--pieces", type=int, default=8, help="кусков в потоковом ответе")
+    parser.add_argument("--stream", action="store_true", help="потоковые ответы (STREAM_RESPONSES)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="файл базы (по умолчанию — временный, удаляется после теста)")
+    args = parser.parse_args()
+    
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.ERROR)
+    handlers_module.STREAM_RESPONSES = args.stream
+    
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = args.db or os.path.join(directory, "load_test.db")
+        test = LoadTest(args, db_path)
+        test.prepare()
+        test.handlers.db.flush()
+        size_before = db_size(db_path)
+        
+        elapsed = asyncio.run(test.run())
+        
+        size_after = db_size(db_path)
+        test.handlers.db.close()
+    
+    updates = sum(len(values) for values in test.latencies.values())
+    
+    print(f"пользователей: {args.users}, обновлений: {updates}, время: {elapsed:.2f} сек")
+    print(f"пропускная способность: {updates / elapsed:.1f} обновлений/сек, "
+          f"запросов к Gemini: {test.model.calls} ({test.model.calls / elapsed:.1f}/сек)")
+    print()
+    print(f"{'обработчик':>12} {'число':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'макс, мс':>9}")
+    
+    for name, values in sorted(test.latencies.items()):
+        values.sort()
+        print(f"{name:>12} {len(values):>7} "
+              f"{percentile(values, 0.50) * 1000:>9.1f} {percentile(values, 0.95) * 1000:>9.1f} "
+              f"{percentile(values, 0.99) * 1000:>9.1f} {values[-1] * 1000:>9.1f}")
+    
+    print()
+    print(f"Telegram: отправлено {test.telegram.sent}, правок {test.telegram.edited}, "
+          f"отклонено {test.telegram.rejected}, символов {test.telegram.chars}")
+    print(f"ошибок обработчиков: {test.errors}")
+    print(f"база: {size_before / 1024:.0f} КБ -> {size_after / 1024:.0f} КБ "
+          f"(+{(size_after - size_before) / 1024:.0f} КБ, "
+          f"{(size_after - size_before) / max(1, updates):.0f} байт на обновление)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# benchmarks/microbench.py - микробенчмарки горячих функций с базовой линией в JSON
+#
+# Запуск из папки бота:
+#   python benchmarks/microbench.py --save                 # записать базовую линию
+#   python benchmarks/microbench.py --compare              # сравнить с ней (код выхода 1 — регрессия)
+#   python benchmarks/microbench.py --db-sizes 10k,1m,10m  # база на 10M строк (несколько ГБ, долго)
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firebase_service import DatabaseService  # noqa: E402
+from utils.chunker import split_message, iter_chunks, StreamChunker  # noqa: E402
+from utils.formatter import format_code, to_markdown_v2, escape_markdown, clean_response  # noqa: E402
+from benchmarks.samples import model_output  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+TEXT_SIZES = {
+    "1k": 1_000,
+    "10k": 10_000,
+    "100k": 100_000,
+}
+
+DB_SIZES = {
+    "10k": 10_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+}
+
+MESSAGES_PER_USER = 20  # строк conversations на пользователя в тестовой базе
+CALLS = 2_000  # вызовов функции базы на один замер
+
+
+def best_of(func, repeat: int = 3, min_time: float = 0.2) -> float:
+    """Лучшее время одного вызова func(), мкс (число вызовов подбирается под min_time)"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+# ========================================
+# ТЕКСТ
+# ========================================
+
+def stream_split(text: str, piece: int = 40) -> list:
+    """Разбивка ответа, пришедшего потоком кусками по piece символов"""
+    chunker = StreamChunker()
+    chunks = []
+    for start in range(0, len(text), piece):
+        chunks.extend(chunker.feed(text[start:start + piece]))
+    chunks.extend(chunker.finish())
+    return chunks
+
+
+def bench_text(results: dict):
+    functions = (
+        ("split_message", split_message),
+        ("iter_chunks", lambda text: list(iter_chunks(text))),
+        ("stream_split", stream_split),
+        ("format_code", format_code),
+        ("to_markdown_v2", to_markdown_v2),
+        ("escape_markdown", escape_markdown),
+        ("clean_response", clean_response),
+    )
+    
+    for size_name, size in TEXT_SIZES.items():
+        text = model_output(size)
+        for name, func in functions:
+            key = f"text.{name}[{size_name}]"
+            results[key] = best_of(lambda: func(text))
+            report(key, results[key])
+
+
+# ========================================
+# БАЗА ДАННЫХ
+# ========================================
+
+def build_database(path: str, rows: int):
+    """Тестовая база: rows сообщений, по MESSAGES_PER_USER на пользователя"""
+    DatabaseService(path).close()  # схема и миграции
+    
+    users = max(1, rows // MESSAGES_PER_USER)
+    rng = random.Random(rows)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, plan, daily_requests, last_request_date) VALUES (?, ?, ?, ?, ?)",
+            ((user_id, f"user{user_id}", rng.choice(("free", "free", "free", "premium")), rng.randint(0, 10),
+              time.strftime("%Y-%m-%d")) for user_id in range(1, users + 1))
+        )
+        
+        def messages():
+            for index in range(rows):
+                user_id = index % users + 1
+                role = "user" if index // users % 2 == 0 else "assistant"
+                yield user_id, role, f"сообщение {index}: " + "текст " * rng.randint(5, 30)
+        
+        conn.executemany("INSERT INTO conversations (user_id, role, content) VALUES (?, ?, ?)", messages())
+    
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def bench_database(results: dict, size_name: str, rows: int, data_dir: str, work_dir: str):
+    fixture = os.path.join(data_dir, f"microbench_{size_name}.db")
+    if not os.path.exists(fixture):
+        started = time.perf_counter()
+        build_database(fixture, rows)
+        print(f"  (база {size_name}: {rows} строк построена за {time.perf_counter() - started:.1f} сек)")
+    
+    # Замеры пишут в базу, поэтому работают с копией: каждый запуск начинается с одних и тех же данных
+    path = os.path.join(work_dir, f"run_{size_name}.db")
+    shutil.copyfile(fixture, path)
+    
+    users = max(1, rows // MESSAGES_PER_USER)
+    rng = random.Random(1)
+    db = DatabaseService(path)
+    
+    def run(func, calls: list) -> float:
+        started = time.perf_counter()
+        for args in calls:
+            func(*args)
+        db.flush()  # запись в фоне считается вместе с коммитом
+        return (time.perf_counter() - started) / len(calls) * 1e6
+    
+    def per_call(name: str, func, make_calls, cached: bool = False, repeat: int = 5):
+        # Лучший из repeat проходов; каждый начинается с пустых кэшей в памяти, а пользователи
+        # в проходе не повторяются, поэтому db.<функция> — время SQLite при любом размере базы.
+        # cached — ещё и повтор тех же вызовов, когда всё уже в кэше (db.<функция>.cached)
+        cold = warm = None
+        for _ in range(repeat):
+            calls = make_calls()
+            db.clear_caches()
+            elapsed = run(func, calls)
+            cold = elapsed if cold is None else min(cold, elapsed)
+            if cached:
+                elapsed = run(func, calls)
+                warm = elapsed if warm is None else min(warm, elapsed)
+        
+        results[f"db.{name}[{size_name}]"] = cold
+        report(f"db.{name}[{size_name}]", cold)
+        if cached:
+            results[f"db.{name}.cached[{size_name}]"] = warm
+            report(f"db.{name}.cached[{size_name}]", warm)
+    
+    def random_users() -> list:
+        return [(user_id,) for user_id in rng.sample(range(1, users + 1), min(users, CALLS))]
+    
+    def activations() -> list:
+        # Каждый код активирует один раз свой пользователь
+        batch = []
+        for user_id in rng.sample(range(1, users + 1), min(users, CALLS // 4)):
+            code = f"BENCH-{size_name}-{len(codes)}"
+            codes.append(code)
+            db.create_promocode(code, "requests", requests=5, uses=1)
+            batch.append((user_id, code))
+        return batch
+    
+    codes = []
+    try:
+        per_call("get_user", db.get_user, random_users, cached=True)
+        per_call("get_remaining_requests", db.get_remaining_requests, random_users, cached=True)
+        per_call("get_conversation_history", db.get_conversation_history, random_users, cached=True)
+        per_call("save_message", db.save_message,
+                 lambda: [(user_id, "user", "новое сообщение для бенчмарка") for user_id, in random_users()])
+        per_call("activate_promocode", db.activate_promocode, activations)
+    finally:
+        db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+# ========================================
+# БАЗОВАЯ ЛИНИЯ
+# ========================================
+
+def report(key: str, microseconds: float):
+    print(f"{key:>48} {microseconds:>12.1f} мкс")
+
+
+def save_baseline(path: str, results: dict):
+    data = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": {key: round(value, 3) for key, value in sorted(results.items())},
+    }
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False, indent=2)
+        file.write("\n")
+    print(f"\n💾 Базовая линия сохранена: {path}")
+
+
+def compare_baseline(path: str, results: dict, threshold: float) -> int:
+    """Сравнить с базовой линией; число замеров, ставших медленнее больше чем на threshold"""
+    with open(path, encoding="utf-8") as file:
+        baseline = json.load(file)["results"]
+    
+    regressions = 0
+    print(f"\n{'замер':>48} {'было, мкс':>12} {'стало, мкс':>12} {'изменение':>10}")
+    
+    for key, value in sorted(results.items()):
+        before = baseline.get(key)
+        if not before:
+            print(f"{key:>48} {'—':>12} {value:>12.1f}       новый")
+            continue
+        
+        change = value / before - 1
+        mark = ""
+        if change > threshold:
+            mark = "  ❌ регрессия"
+            regressions += 1
+        elif change < -threshold:
+            mark = "  ✅ быстрее"
+        print(f"{key:>48} {before:>12.1f} {value:>12.1f} {change:>+9.0%}{mark}")
+    
+    print(f"\nрегрессий (медленнее больше чем на {threshold:.0%}): {regressions}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки базы, разбивки и форматирования")
+    parser.add_argument("--only", choices=("text", "db"), help="только одна группа замеров")
+    parser.add_argument("--db-sizes", default="10k,1m", help=f"размеры тестовых баз: {', '.join(DB_SIZES)}")
+    parser.add_argument("--data-dir", help="папка для тестовых баз (сохраняются между запусками)")
+    parser.add_argument("--save", nargs="?", const=BASELINE_PATH, help="сохранить результаты как базовую линию")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_PATH, help="сравнить с базовой линией")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление (0.2 — 20%%)")
+    args = parser.parse_args()
+    
+    if args.compare and not os.path.exists(args.compare):
+        parser.error(f"нет базовой линии {args.compare} — сначала запустите с --save")
+    
+    results = {}
+    
+    if args.only in (None, "text"):
+        bench_text(results)
+    
+    if args.only in (None, "db"):
+        with tempfile.TemporaryDirectory() as work_dir:
+            data_dir = args.data_dir or work_dir
+            os.makedirs(data_dir, exist_ok=True)
+            for size_name in args.db_sizes.split(","):
+                bench_database(results, size_name, DB_SIZES[size_name.strip()], data_dir, work_dir)
+    
+    if args.save:
+        save_baseline(args.save, results)
+    
+    if args.compare:
+        if compare_baseline(args.compare, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
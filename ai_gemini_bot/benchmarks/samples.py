@@ -0,0 +1,70 @@
+# benchmarks/samples.py - тестовые ответы модели для бенчмарков
+import random
+
+WORDS = [
+    "модель", "ответ", "пользователь", "запрос", "данные", "функция", "список",
+    "**важно**", "`код`", "*курсив*", "[ссылка](https://example.com)", "значение",
+    "результат.", "например,", "итог!", "вопрос?",
+]
+
+
+def paragraph(rng: random.Random, words: int) -> str:
+    """Абзац обычного текста с inline-разметкой"""
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def code_block(rng: random.Random, lines: int, language: str = "python") -> str:
+    """Блок кода ``` на lines строк"""
+    body = "\n".join(
+        f"    result_{i} = process(data[{i}], key='{rng.choice(WORDS)}')  # шаг {i}"
+        for i in range(lines)
+    )
+    return f"```{language}\n{body}\n```"
+
+
+def model_output(size: int, seed: int = 42) -> str:
+    """
+    Ответ модели не длиннее size символов (обычно чуть короче: обрезается по
+    границе строки): абзацы, списки, блоки кода (включая блоки длиннее одного
+    сообщения Telegram) и сплошные строки без переносов
+    """
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    
+    while total < size:
+        kind = rng.random()
+        if kind < 0.45:
+            part = paragraph(rng, rng.randint(20, 150))
+        elif kind < 0.6:
+            part = "\n".join(f"- {paragraph(rng, rng.randint(3, 15))}" for _ in range(rng.randint(3, 10)))
+        elif kind < 0.85:
+            part = code_block(rng, rng.randint(5, 60))
+        elif kind < 0.95:
+            part = code_block(rng, rng.randint(100, 300))  # длиннее 4096 символов
+        else:
+            part = paragraph(rng, rng.randint(800, 2000))  # одна очень длинная строка
+        
+        parts.append(part)
+        total += len(part) + 2
+    
+    text = "\n\n".join(parts)
+    if len(text) <= size:
+        return text
+    
+    # Обрезаем по границе строки (если она недалеко), открытый блок кода закрываем
+    cut = text.rfind("\n", 0, size - 4)
+    if cut < size * 9 // 10:
+        cut = size - 4
+    text = text[:cut].rstrip()
+    if text.count("```") % 2:
+        text += "\n```"
+    return text
+
+
+# Размеры: обычный ответ, длинный ответ, «простыня» (лог, большой файл)
+SIZES = {
+    "4k": 4_000,
+    "32k": 32_000,
+    "256k": 256_000,
+}
@@ -1,9 +1,18 @@
 # bot.py - главный файл запуска бота
 import logging
+import secrets
+import signal
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from config import TELEGRAM_TOKEN
+from telegram.ext import (Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler,
+                          filters, ContextTypes)
+from config import (TELEGRAM_TOKEN, BOT_MODE, CONCURRENT_UPDATES, WEBHOOK_LISTEN, WEBHOOK_PORT,
+                    WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET, WORKER_PROCESSES,
+                    METRICS_ENABLED, METRICS_HOST, METRICS_PORT, PROFILER_SECONDS)
 from handlers import BotHandlers
+from firebase_service import DatabaseService
+from sharding import WorkerPool
+import metrics
+from tracing import PROFILER
 from gemini_api import GeminiAPI # Импортируем класс GeminiAPI
 
 # Настройка логирования
@@ -17,7 +26,7 @@ logger = logging.getLogger(__name__)
 def main():
     """Запуск бота"""
     logger.info("🚀 Запуск бота...")
-
+    
     # Проверка подключения к Gemini API
     logger.info("🔄 Проверка подключения к Gemini API...")
     gemini_tester = GeminiAPI() # Создаем временный объект для теста
@@ -25,11 +34,43 @@ def main():
         logger.error("❌ Не удалось подключиться к Gemini. Проверьте ваш GEMINI_API_KEY в config.py")
         return # Останавливаем запуск, если ключ неверный
     
-    # Создание приложения
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Несколько процессов: этот только принимает обновления
+    if WORKER_PROCESSES > 0:
+        run_sharded(WORKER_PROCESSES)
+        return
     
     # Инициализация обработчиков
     handlers = BotHandlers()
+    metrics_server = None
+    
+    async def post_init(application: Application):
+        nonlocal metrics_server
+        metrics_server = await start_metrics(METRICS_PORT)
+    
+    async def post_shutdown(application: Application):
+        """Дописать очередь записи в базу перед выходом"""
+        if metrics_server is not None:
+            metrics_server.close()
+        handlers.db.close()
+        logger.info("💾 База данных закрыта")
+    
+    app = build_application(handlers, post_shutdown, post_init)
+    
+    logger.info("✅ Бот успешно запущен!")
+    logger.info("📝 Нажми Ctrl+C для остановки")
+    
+    serve(app)
+
+
+def build_application(handlers: BotHandlers, post_shutdown=None, post_init=None) -> Application:
+    """Приложение с обработчиками бота (весь бот в одном процессе или один воркер)"""
+    # Обновления разных пользователей обрабатываются параллельно
+    builder = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(CONCURRENT_UPDATES)
+    if post_shutdown is not None:
+        builder = builder.post_shutdown(post_shutdown)
+    if post_init is not None:
+        builder = builder.post_init(post_init)
+    app = builder.build()
     
     # Регистрация команд
     app.add_handler(CommandHandler("start", handlers.start))
@@ -37,6 +78,7 @@ def main():
     app.add_handler(CommandHandler("upgrade", handlers.upgrade))
     app.add_handler(CommandHandler("stats", handlers.stats))
     app.add_handler(CommandHandler("clear", handlers.clear_history))
+    app.add_handler(CommandHandler("profile", handlers.profile))  # только для ADMIN_IDS
     
     # Обработка кнопок
     app.add_handler(CallbackQueryHandler(handlers.button_callback))
@@ -44,11 +86,108 @@ def main():
     # Обработка текстовых сообщений
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_message))
     
-    logger.info("✅ Бот успешно запущен!")
+    return app
+
+
+async def start_metrics(port: int):
+    """HTTP-сервер /metrics (None, если метрики выключены или порт занят)"""
+    if not METRICS_ENABLED:
+        return None
+    
+    try:
+        return await metrics.start_server(METRICS_HOST, port)
+    except OSError as e:
+        logger.error(f"❌ Не удалось запустить сервер метрик на порту {port}: {e}")
+        return None
+
+
+def enable_profiler_signal():
+    """kill -USR1 <pid> — профилировать процесс PROFILER_SECONDS секунд (файл в PROFILER_DIR)"""
+    if not hasattr(signal, "SIGUSR1"):
+        return  # Windows
+    
+    def on_signal(signum, frame):
+        if not PROFILER.start(PROFILER_SECONDS):
+            logger.info("🔬 Профилирование уже идёт")
+    
+    signal.signal(signal.SIGUSR1, on_signal)
+
+
+def serve(app: Application):
+    """Получать обновления: polling или webhook (BOT_MODE)"""
+    enable_profiler_signal()
+    if BOT_MODE == "webhook":
+        run_webhook(app)
+    else:
+        # Запуск polling
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+def run_sharded(workers: int):
+    """
+    Главный процесс при WORKER_PROCESSES > 0
+    
+    Принимает обновления и раздаёт их воркерам по user_id (sharding.py);
+    обработчики, Gemini и база работают только в воркерах.
+    """
+    # Схема базы и миграции — один раз, до запуска воркеров
+    DatabaseService().close()
+    
+    pool = WorkerPool(workers)
+    metrics.register_pool(pool)
+    metrics_server = None
+    
+    async def post_init(application: Application):
+        nonlocal metrics_server
+        pool.start()
+        metrics_server = await start_metrics(METRICS_PORT)
+    
+    async def post_shutdown(application: Application):
+        if metrics_server is not None:
+            metrics_server.close()
+        pool.stop()
+    
+    # Без concurrent_updates: в очереди воркеров обновления попадают в порядке получения
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    app.add_handler(TypeHandler(Update, pool.dispatch))
+    
+    logger.info(f"✅ Бот запущен: {workers} воркеров")
     logger.info("📝 Нажми Ctrl+C для остановки")
     
-    # Запуск polling
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    serve(app)
+
+
+def run_webhook(app: Application):
+    """
+    Запуск встроенного HTTP-сервера: Telegram сам присылает обновления
+    
+    Вебхук регистрируется при старте (WEBHOOK_URL + WEBHOOK_PATH); запросы
+    без правильного secret_token сервер отклоняет.
+    """
+    if not WEBHOOK_URL:
+        raise ValueError("Для BOT_MODE = 'webhook' укажите WEBHOOK_URL в config.py")
+    
+    path = WEBHOOK_PATH.strip('/')
+    webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{path}"
+    secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    
+    logger.info(f"🌐 Вебхук: {webhook_url} (сервер {WEBHOOK_LISTEN}:{WEBHOOK_PORT})")
+    
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=path,
+        webhook_url=webhook_url,
+        secret_token=secret_token,
+        max_connections=min(CONCURRENT_UPDATES, 100),  # параллельных соединений от Telegram (1-100)
+        allowed_updates=Update.ALL_TYPES
+    )
 
 
 if __name__ == '__main__':
@@ -60,9 +60,110 @@ BOT_PERSONALITY = [
 # ===========================================
 GEMINI_MODEL = "gemini-2.0-flash"  # быстрая и стабильная модель
 MAX_HISTORY = 8  # количество сообщений в истории (экономия токенов)
+HISTORY_FETCH_LIMIT = {  # сколько последних сообщений достаём из базы по тарифам
+    "free": MAX_HISTORY,
+    "premium": 30,
+    "vip": 50,
+}
+HISTORY_TOKEN_BUDGET = {  # токенов истории в промпте («длинная память» платных тарифов)
+    "free": 1000,
+    "premium": 4000,
+    "vip": 8000,
+}
+HISTORY_TURN_MAX_TOKENS = 500  # длиннее — реплика сокращается (начало + конец); не больше половины наименьшего бюджета
+HISTORY_TURN_MIN_TOKENS = 100  # остаток бюджета меньше — старые реплики не сокращаются, а отбрасываются
+TOKEN_CHARS_PER_TOKEN = 3.0  # начальная оценка символов на токен (уточняется по ответам Gemini)
+TOKEN_CALIBRATION_WEIGHT = 0.1  # вес нового замера при уточнении
 MAX_MESSAGE_LENGTH = 4000  # максимальная длина ответа
+GEMINI_MAX_CONCURRENT = 8  # одновременных запросов к Gemini (остальные ждут в очереди)
+SCHEDULER_PLAN_WEIGHTS = {  # доля мест в очереди к Gemini при перегрузке
+    "vip": 8,
+    "premium": 4,
+    "free": 1,
+    "background": 0.25,  # фоновые задачи (сжатие истории): при перегрузке в 4 раза реже free
+}
+GEMINI_TIMEOUT = 60  # секунд на один запрос к Gemini
+GEMINI_CONTEXT_CACHE = False  # хранить личность бота в кэше контекста Gemini (модели с поддержкой кэша, от ~1-4K токенов)
+GEMINI_CONTEXT_CACHE_TTL = 3600  # секунд жизни кэша контекста (продлевается автоматически)
+STREAM_RESPONSES = True  # показывать ответ по мере генерации (редактированием сообщения)
+STREAM_EDIT_INTERVAL = 1.0  # секунд между правками сообщения (лимиты Telegram)
+
+# Лимиты Gemini API (значения для своего тарифа: https://ai.google.dev/gemini-api/docs/rate-limits)
+GEMINI_RPM = 15  # запросов в минуту
+GEMINI_TPM = 1_000_000  # токенов в минуту
+GEMINI_RATE_BURST = 0.25  # какую долю минутного лимита можно израсходовать разом
+GEMINI_AIMD_INCREASE = 0.05  # +5% скорости за каждый успешный запрос после 429
+GEMINI_AIMD_DECREASE = 0.5  # скорость x0.5 при каждом ответе 429
+GEMINI_AIMD_MIN_FACTOR = 0.1  # ниже 10% от лимита не опускаемся
+GEMINI_MAX_RETRIES = 2  # повторов при 429 и временных сбоях (500/503/504)
+GEMINI_RETRY_BASE_DELAY = 1.0  # секунд до первого повтора (дальше x2, со случайным разбросом)
+GEMINI_RETRY_MAX_DELAY = 20.0  # дольше API просит ждать — сразу отвечаем пользователю ошибкой
+GEMINI_BREAKER_FAILURES = 5  # сбоев подряд, после которых перестаём обращаться к API
+GEMINI_BREAKER_RESET = 30.0  # секунд до пробного запроса после отключения
 
 # ===========================================
 # БАЗА ДАННЫХ
 # ===========================================
-DATABASE_PATH = "bot_database.db"
\ No newline at end of file
+DATABASE_PATH = "bot_database.db"
+DB_BUSY_TIMEOUT = 5.0  # секунд ждать, пока база занята другим запросом
+DB_SYNCHRONOUS = "NORMAL"  # NORMAL — быстро (WAL), FULL — fsync на каждый коммит
+DB_STATEMENT_CACHE = 128  # подготовленных запросов на одно соединение
+DB_WRITE_BEHIND = True  # писать историю и счётчики в фоне пачками (False — сразу, каждую запись)
+DB_FLUSH_INTERVAL = 0.05  # секунд копить записи перед общим коммитом
+DB_FLUSH_BATCH = 500  # максимум записей в одной транзакции
+USER_CACHE_SIZE = 10000  # пользователей в кэше памяти
+USER_CACHE_TTL = 300  # секунд хранить запись пользователя в кэше
+HISTORY_CACHE_TURNS = max(HISTORY_FETCH_LIMIT.values())  # последних реплик на пользователя в памяти
+HISTORY_CACHE_IDLE_TTL = 1800  # секунд без сообщений, после которых диалог выгружается из памяти
+HISTORY_CACHE_MAX_CHARS = 20_000_000  # общий лимит текста истории в памяти (символов)
+
+# ===========================================
+# КЭШ ОТВЕТОВ
+# ===========================================
+RESPONSE_CACHE_ENABLED = True  # одинаковые вопросы — без повторного запроса к Gemini
+RESPONSE_CACHE_SIZE = 5000  # ответов в памяти
+RESPONSE_CACHE_TTL = 6 * 3600  # секунд хранить ответ (в памяти и в базе)
+RESPONSE_CACHE_DB_MAX_ROWS = 50000  # ответов в базе (лишние удаляются при чистке)
+RESPONSE_CACHE_PURGE_INTERVAL = 600  # секунд между чистками таблицы кэша
+RESPONSE_CACHE_WITH_HISTORY = False  # кэшировать и ответы, зависящие от истории диалога
+
+# ===========================================
+# СЖАТИЕ ИСТОРИИ
+# ===========================================
+SUMMARY_ENABLED = True  # заменять старые реплики кратким содержанием
+SUMMARY_TRIGGER_MESSAGES = 40  # несжатых сообщений, после которых запускается сжатие
+SUMMARY_KEEP_RECENT = 20  # последних сообщений всегда остаются как есть
+SUMMARY_BATCH = 100  # максимум сообщений, сжимаемых за один запрос к Gemini
+SUMMARY_MAX_WORDS = 250  # длина краткого содержания
+SUMMARY_MAX_TOKENS = 512  # лимит ответа Gemini при сжатии
+
+# ===========================================
+# ЗАПУСК
+# ===========================================
+BOT_MODE = "polling"  # polling — бот сам опрашивает Telegram, webhook — Telegram присылает обновления на наш HTTP-сервер
+CONCURRENT_UPDATES = 64  # обновлений обрабатывается одновременно (1 — строго по очереди)
+USER_QUEUE_LIMIT = 5  # сообщений одного пользователя в очереди (обрабатываются по одному); лишние отклоняются
+WORKER_PROCESSES = 0  # процессов-обработчиков, между которыми делятся пользователи (0 — всё в одном процессе)
+WORKER_HEARTBEAT_INTERVAL = 2.0  # секунд между отметками «жив» от воркера
+WORKER_HEARTBEAT_TIMEOUT = 60.0  # секунд без отметки — воркер считается зависшим и перезапускается
+WEBHOOK_LISTEN = "0.0.0.0"  # адрес встроенного HTTP-сервера
+WEBHOOK_PORT = 8443  # порт сервера (Telegram шлёт на 443, 80, 88 или 8443 — или через прокси)
+WEBHOOK_PATH = "telegram"  # путь, на который приходят обновления
+WEBHOOK_URL = ""  # публичный адрес сервера, например https://bot.example.com (путь добавится сам)
+WEBHOOK_SECRET = ""  # secret_token для заголовка X-Telegram-Bot-Api-Secret-Token (пусто — случайный при запуске)
+
+# ===========================================
+# МЕТРИКИ
+# ===========================================
+METRICS_ENABLED = True  # HTTP-адрес /metrics для Prometheus (время этапов, токены, очереди, кэши, ошибки)
+METRICS_HOST = "127.0.0.1"  # 0.0.0.0 — доступно снаружи
+METRICS_PORT = 9100  # в режиме воркеров: главный процесс — 9100, воркеры — 9101, 9102, ...
+
+# ===========================================
+# ТРАССИРОВКА И ПРОФИЛИРОВАНИЕ
+# ===========================================
+TRACE_SLOW_SECONDS = 10.0  # обновления дольше — в лог "trace" строкой JSON с этапами (trace_id, span)
+PROFILER_INTERVAL = 0.01  # секунд между снимками стеков (100 в секунду)
+PROFILER_SECONDS = 30  # длительность профилирования по умолчанию (/profile, сигнал SIGUSR1)
+PROFILER_MAX_SECONDS = 300  # больше через /profile не запустить
+PROFILER_DIR = "profiles"  # папка для файлов .folded (flamegraph.pl, speedscope)
\ No newline at end of file
@@ -1,21 +1,227 @@
 # firebase_service.py - работа с базой данных (SQLite вместо Firebase)
+import atexit
+import queue
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
-from config import DATABASE_PATH, FREE_DAILY_LIMIT, MAX_HISTORY
+from config import (DATABASE_PATH, FREE_DAILY_LIMIT, MAX_HISTORY,
+                    DB_BUSY_TIMEOUT, DB_SYNCHRONOUS, DB_STATEMENT_CACHE,
+                    DB_WRITE_BEHIND, DB_FLUSH_INTERVAL, DB_FLUSH_BATCH,
+                    USER_CACHE_SIZE, USER_CACHE_TTL,
+                    HISTORY_CACHE_TURNS, HISTORY_CACHE_IDLE_TTL, HISTORY_CACHE_MAX_CHARS,
+                    RESPONSE_CACHE_DB_MAX_ROWS, RESPONSE_CACHE_PURGE_INTERVAL)
+from utils.cache import LRUCache, HistoryCache
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Миграции схемы: (версия, описание, SQL-запросы).
+# Применённая версия хранится в PRAGMA user_version; новые — только дописывать в конец.
+MIGRATIONS = [
+    (1, "индекс истории диалога по пользователю", [
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations (user_id, id)",
+    ]),
+    (2, "индекс подсчёта сообщений по роли", [
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_role ON conversations (user_id, role)",
+    ]),
+    (3, "кэш ответов Gemini", [
+        """
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            expires_at REAL
+        )
+        """,
+    ]),
+    (4, "краткое содержание старой части диалога", [
+        """
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at TEXT
+        )
+        """,
+    ]),
+    (5, "индекс срока жизни кэша ответов", [
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires_at)",
+    ]),
+]
+
+# Чистка кэша ответов: устаревшие строки и всё сверх лимита (сначала — ближайшие к истечению)
+PURGE_EXPIRED_RESPONSES = "DELETE FROM response_cache WHERE expires_at <= ?"
+PURGE_EXTRA_RESPONSES = """
+    DELETE FROM response_cache WHERE key IN (
+        SELECT key FROM response_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+    )
+"""
+
+# Служебные метки очереди записи
+_FLUSH = object()  # закоммитить накопленное немедленно
+_STOP = object()   # закоммитить и завершить поток записи
+
 
 class DatabaseService:
-    def __init__(self):
-        """Инициализация базы данных"""
-        self.db_path = DATABASE_PATH
+    def __init__(self, db_path: str = None):
+        """
+        Инициализация базы данных
+        
+        Args:
+            db_path: файл базы (None — DATABASE_PATH из config.py)
+        """
+        self.db_path = db_path or DATABASE_PATH
+        
+        # Одно постоянное соединение на поток вместо connect/close в каждом методе
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        
+        # Кэш записей users: все изменения пользователя проходят через этот класс
+        self._users = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        
+        # Последние реплики активных диалогов; таблица conversations остаётся основной копией
+        self._history = HistoryCache(HISTORY_CACHE_TURNS, HISTORY_CACHE_IDLE_TTL, HISTORY_CACHE_MAX_CHARS)
+        
+        # Краткие содержания диалогов ({} — содержания нет)
+        self._summaries = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        
+        # Следующая чистка таблицы response_cache (первую делает ResponseCache при запуске)
+        self._response_purge_at = time.monotonic() + RESPONSE_CACHE_PURGE_INTERVAL
+        
         self._init_database()
+        
+        # Фоновая запись пачками: история и счётчики не ждут fsync в обработчике
+        self._write_queue = queue.Queue()
+        self._writer = None
+        if DB_WRITE_BEHIND:
+            self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Соединение текущего потока (открывается один раз и переиспользуется)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT,
+            cached_statements=DB_STATEMENT_CACHE,  # кэш подготовленных запросов
+            check_same_thread=False  # закрываем из close() в любом потоке
+        )
+        conn.row_factory = sqlite3.Row
+        
+        # WAL: читатели не блокируют писателя, NORMAL: без fsync на каждый коммит
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+        
+        self._local.conn = conn
+        with self._connections_lock:
+            self._connections.append(conn)
+        
+        return conn
+    
+    def close(self):
+        """Дописать очередь записи и закрыть все соединения с базой"""
+        if self._writer is not None and self._writer.is_alive():
+            self._write_queue.put(_STOP)
+            self._writer.join()
+        
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        
+        self._local = threading.local()
+    
+    # ========================================
+    # ФОНОВАЯ ЗАПИСЬ
+    # ========================================
+    
+    def _write(self, sql: str, params: tuple = ()):
+        """Записать сразу или поставить в очередь фоновой записи"""
+        if self._writer is None or not self._writer.is_alive():
+            with self._connect() as conn:
+                conn.execute(sql, params)
+            return
+        
+        self._write_queue.put((sql, params))
+    
+    def flush(self):
+        """
+        Дождаться, пока все записи из очереди попадут в базу
+        
+        Блокирует поток на время коммита — из event loop вызывать
+        (и всё, что вызывает flush) через asyncio.to_thread.
+        """
+        if self._writer is None or not self._writer.is_alive():
+            return
+        
+        if self._write_queue.unfinished_tasks:
+            self._write_queue.put(_FLUSH)
+            self._write_queue.join()
+    
+    def _writer_loop(self):
+        """Поток записи: собирает пачку (по размеру или по времени) и коммитит её одной транзакцией"""
+        running = True
+        
+        while running:
+            batch = []
+            markers = 0
+            item = self._write_queue.get()
+            deadline = time.monotonic() + DB_FLUSH_INTERVAL
+            
+            while True:
+                if item is _STOP:
+                    running = False
+                    markers += 1
+                    break
+                if item is _FLUSH:
+                    markers += 1
+                    break
+                
+                batch.append(item)
+                if len(batch) >= DB_FLUSH_BATCH:
+                    break
+                
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            
+            self._commit_batch(batch)
+            
+            for _ in range(len(batch) + markers):
+                self._write_queue.task_done()
+    
+    def _commit_batch(self, batch: list):
+        """Одна транзакция на всю пачку; при ошибке — по одной записи"""
+        if not batch:
+            return
+        
+        conn = self._connect()
+        try:
+            with conn:
+                for sql, params in batch:
+                    conn.execute(sql, params)
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка записи пачки ({len(batch)} шт.), пишу по одной: {e}")
+            for sql, params in batch:
+                try:
+                    with conn:
+                        conn.execute(sql, params)
+                except sqlite3.Error as e:
+                    logger.error(f"❌ Запись потеряна: {e}")
     
     def _init_database(self):
         """Создание таблиц"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         # Таблица пользователей
@@ -65,64 +271,116 @@ class DatabaseService:
         """)
         
         conn.commit()
-        conn.close()
+        
+        self._run_migrations(conn)
         logger.info("✅ База данных инициализирована")
     
+    def _run_migrations(self, conn: sqlite3.Connection):
+        """Применить миграции новее текущей версии схемы"""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        
+        for target, description, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            
+            logger.info(f"🔧 Миграция {target}: {description}...")
+            
+            # Миграция и новая версия — одной транзакцией
+            with conn:
+                conn.execute("BEGIN")
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {target}")
+            
+            version = target
+    
     # ========================================
     # ПОЛЬЗОВАТЕЛИ
     # ========================================
     
     def get_user(self, user_id: int):
         """Получить пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        user = self._users.get(user_id)
+        if user is not None:
+            return dict(user)
         
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        cursor = self._connect().execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         user = cursor.fetchone()
-        conn.close()
+        if not user:
+            return None
         
-        return dict(user) if user else None
+        user = dict(user)
+        self._users.set(user_id, user)
+        return dict(user)
+    
+    def _update_cached_user(self, user_id: int, **fields):
+        """Write-through: поправить запись в кэше, если она там есть"""
+        user = self._users.peek(user_id)
+        if user is not None:
+            user.update(fields)
+    
+    def get_cache_stats(self) -> dict:
+        """Статистика кэшей в памяти"""
+        return {"users": self._users.stats(), "history": self._history.stats()}
+    
+    def clear_caches(self):
+        """Забыть кэши в памяти: следующие чтения идут в базу (бенчмарки)"""
+        self.flush()
+        self._users.clear()
+        self._history.clear()
+        self._summaries.clear()
     
     def create_user(self, user_id: int, username: str):
         """Создать пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         today = datetime.now().strftime("%Y-%m-%d")
-        cursor.execute("""
-            INSERT OR IGNORE INTO users (user_id, username, last_request_date, daily_requests)
-            VALUES (?, ?, ?, 0)
-        """, (user_id, username, today))
         
-        conn.commit()
-        conn.close()
+        with self._connect() as conn:
+            conn.execute("""
+                INSERT OR IGNORE INTO users (user_id, username, last_request_date, daily_requests)
+                VALUES (?, ?, ?, 0)
+            """, (user_id, username, today))
+            
+            # created_at заполняет база — кэшируем запись в том виде, как она сохранена
+            user = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        
+        if user:
+            self._users.set(user_id, dict(user))
+        
         logger.info(f"✅ Новый пользователь: {user_id}")
     
     def update_user_plan(self, user_id: int, plan: str, days: int = None):
         """Обновить тарифный план"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._connect() as conn:
+            fields = self._apply_plan(conn.cursor(), user_id, plan, days)
+        
+        self._update_cached_user(user_id, **fields)
+    
+    def _apply_plan(self, cursor, user_id: int, plan: str, days: int = None) -> dict:
+        """
+        Смена тарифа внутри уже открытой транзакции
         
+        Returns:
+            dict: изменённые поля пользователя (для кэша после коммита)
+        """
         if plan == 'vip':
             cursor.execute("""
                 UPDATE users SET plan = 'vip', premium_expires = NULL
                 WHERE user_id = ?
             """, (user_id,))
+            return {"plan": 'vip', "premium_expires": None}
         elif plan == 'premium' and days:
             expires = (datetime.now() + timedelta(days=days)).isoformat()
             cursor.execute("""
                 UPDATE users SET plan = 'premium', premium_expires = ?
                 WHERE user_id = ?
             """, (expires, user_id))
+            return {"plan": 'premium', "premium_expires": expires}
         else:
             cursor.execute("""
                 UPDATE users SET plan = 'free', premium_expires = NULL
                 WHERE user_id = ?
             """, (user_id,))
-        
-        conn.commit()
-        conn.close()
+            return {"plan": 'free', "premium_expires": None}
     
     def get_remaining_requests(self, user_id: int) -> int:
         """Получить оставшиеся запросы"""
@@ -155,30 +413,106 @@ class DatabaseService:
     
     def _reset_daily_requests(self, user_id: int):
         """Сброс дневного счётчика"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         today = datetime.now().strftime("%Y-%m-%d")
-        cursor.execute("""
-            UPDATE users SET daily_requests = 0, last_request_date = ?
-            WHERE user_id = ?
-        """, (today, user_id))
         
-        conn.commit()
-        conn.close()
+        with self._connect() as conn:
+            conn.execute("""
+                UPDATE users SET daily_requests = 0, last_request_date = ?
+                WHERE user_id = ?
+            """, (today, user_id))
+        
+        self._update_cached_user(user_id, daily_requests=0, last_request_date=today)
     
-    def use_request(self, user_id: int):
-        """Использовать один запрос"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    # ========================================
+    # ЛИМИТ ЗАПРОСОВ
+    # ========================================
+    
+    def try_consume(self, user_id: int) -> dict:
+        """
+        Проверить лимит и списать один запрос — атомарно, одним UPDATE
+        
+        Сброс дневного счётчика, окончание премиума и списание делаются
+        одним условным UPDATE ... RETURNING, поэтому два параллельных
+        сообщения не пройдут проверку оба. Для VIP и действующего Premium
+        из кэша база не трогается вовсе.
+        
+        Returns:
+            dict: {"allowed": bool, "remaining": int или None (безлимит),
+                   "charged": bool — был ли списан запрос (для refund_request)}
+        """
+        now = datetime.now()
+        now_iso = now.isoformat()
+        today = now.strftime("%Y-%m-%d")
+        
+        # Безлимитные тарифы — без обращения к базе
+        user = self._users.peek(user_id)
+        if user is not None and self._is_unlimited(user, now_iso):
+            return {"allowed": True, "remaining": None, "charged": False}
+        
+        with self._connect() as conn:
+            row = conn.execute("""
+                UPDATE users SET
+                    plan = CASE
+                        WHEN plan = 'premium' AND IFNULL(premium_expires, '') <= :now THEN 'free'
+                        ELSE plan END,
+                    premium_expires = CASE
+                        WHEN plan = 'premium' AND IFNULL(premium_expires, '') <= :now THEN NULL
+                        ELSE premium_expires END,
+                    daily_requests = CASE
+                        WHEN plan = 'vip' OR (plan = 'premium' AND premium_expires > :now) THEN daily_requests
+                        WHEN last_request_date IS :today THEN daily_requests + 1
+                        ELSE 1 END,
+                    last_request_date = CASE
+                        WHEN plan = 'vip' OR (plan = 'premium' AND premium_expires > :now) THEN last_request_date
+                        ELSE :today END
+                WHERE user_id = :user_id AND (
+                    plan = 'vip'
+                    OR (plan = 'premium' AND premium_expires > :now)
+                    OR last_request_date IS NOT :today
+                    OR daily_requests < :limit
+                )
+                RETURNING *
+            """, {"user_id": user_id, "now": now_iso, "today": today, "limit": FREE_DAILY_LIMIT}).fetchone()
+        
+        if row is None:
+            # Лимит исчерпан (или пользователя нет)
+            return {"allowed": False, "remaining": 0, "charged": False}
+        
+        user = dict(row)
+        self._users.set(user_id, user)
+        
+        if self._is_unlimited(user, now_iso):
+            return {"allowed": True, "remaining": None, "charged": False}
+        
+        return {
+            "allowed": True,
+            "remaining": max(0, FREE_DAILY_LIMIT - user['daily_requests']),
+            "charged": True,
+        }
+    
+    def _is_unlimited(self, user: dict, now_iso: str) -> bool:
+        """VIP или действующий Premium (ISO-даты сравниваются как строки, без парсинга)"""
+        if user['plan'] == 'vip':
+            return True
+        return user['plan'] == 'premium' and (user['premium_expires'] or '') > now_iso
+    
+    def refund_request(self, user_id: int, quota: dict):
+        """Вернуть запрос, списанный try_consume (например, если Gemini не ответил)"""
+        if not quota.get('charged'):
+            return
         
-        cursor.execute("""
-            UPDATE users SET daily_requests = daily_requests + 1
-            WHERE user_id = ?
-        """, (user_id,))
+        today = datetime.now().strftime("%Y-%m-%d")
         
-        conn.commit()
-        conn.close()
+        # Только в тот же день: после сброса счётчика возвращать нечего
+        with self._connect() as conn:
+            row = conn.execute("""
+                UPDATE users SET daily_requests = daily_requests - 1
+                WHERE user_id = ? AND last_request_date = ?
+                RETURNING *
+            """, (user_id, today)).fetchone()
+        
+        if row is not None:
+            self._users.set(user_id, dict(row))
     
     # ========================================
     # ПРОМОКОДЫ
@@ -187,71 +521,69 @@ class DatabaseService:
     def create_promocode(self, code: str, promo_type: str, days: int = None, 
                         requests: int = None, uses: int = 1):
         """Создать промокод"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._connect() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO promocodes (code, type, days, requests, uses_left)
+                VALUES (?, ?, ?, ?, ?)
+            """, (code.upper(), promo_type, days, requests, uses))
         
-        cursor.execute("""
-            INSERT OR REPLACE INTO promocodes (code, type, days, requests, uses_left)
-            VALUES (?, ?, ?, ?, ?)
-        """, (code.upper(), promo_type, days, requests, uses))
-        
-        conn.commit()
-        conn.close()
         logger.info(f"✅ Промокод создан: {code}")
     
     def activate_promocode(self, user_id: int, code: str):
         """Активировать промокод"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
         code = code.upper()
         
-        # Проверка существования промокода
-        cursor.execute("SELECT * FROM promocodes WHERE code = ?", (code,))
-        promo = cursor.fetchone()
-        
-        if not promo:
-            conn.close()
-            return {"success": False, "error": "Промокод не найден"}
-        
-        # Проверка использования
-        cursor.execute("""
-            SELECT * FROM used_promocodes WHERE user_id = ? AND code = ?
-        """, (user_id, code))
-        
-        if cursor.fetchone():
-            conn.close()
-            return {"success": False, "error": "Промокод уже использован"}
-        
-        # Проверка лимита использований
-        if promo['uses_left'] <= 0:
-            conn.close()
-            return {"success": False, "error": "Промокод исчерпан"}
-        
-        # Активация
-        if promo['type'] == 'vip':
-            self.update_user_plan(user_id, 'vip')
-        elif promo['type'] == 'premium':
-            self.update_user_plan(user_id, 'premium', promo['days'])
-        elif promo['type'] == 'requests':
+        # Всё в одной транзакции: проверки, смена тарифа, отметка использования
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            
+            # Проверка существования промокода
+            cursor.execute("SELECT * FROM promocodes WHERE code = ?", (code,))
+            promo = cursor.fetchone()
+            
+            if not promo:
+                return {"success": False, "error": "Промокод не найден"}
+            
+            # Проверка использования
             cursor.execute("""
-                UPDATE users SET daily_requests = daily_requests - ?
-                WHERE user_id = ?
-            """, (promo['requests'], user_id))
-        
-        # Отметить использование
-        cursor.execute("""
-            INSERT INTO used_promocodes (user_id, code) VALUES (?, ?)
-        """, (user_id, code))
-        
-        # Уменьшить счётчик использований
-        cursor.execute("""
-            UPDATE promocodes SET uses_left = uses_left - 1 WHERE code = ?
-        """, (code,))
+                SELECT * FROM used_promocodes WHERE user_id = ? AND code = ?
+            """, (user_id, code))
+            
+            if cursor.fetchone():
+                return {"success": False, "error": "Промокод уже использован"}
+            
+            # Проверка лимита использований
+            if promo['uses_left'] <= 0:
+                return {"success": False, "error": "Промокод исчерпан"}
+            
+            # Активация
+            fields = {}
+            if promo['type'] == 'vip':
+                fields = self._apply_plan(cursor, user_id, 'vip')
+            elif promo['type'] == 'premium':
+                fields = self._apply_plan(cursor, user_id, 'premium', promo['days'])
+            elif promo['type'] == 'requests':
+                cursor.execute("""
+                    UPDATE users SET daily_requests = daily_requests - ?
+                    WHERE user_id = ?
+                """, (promo['requests'], user_id))
+            
+            # Отметить использование
+            cursor.execute("""
+                INSERT INTO used_promocodes (user_id, code) VALUES (?, ?)
+            """, (user_id, code))
+            
+            # Уменьшить счётчик использований
+            cursor.execute("""
+                UPDATE promocodes SET uses_left = uses_left - 1 WHERE code = ?
+            """, (code,))
         
-        conn.commit()
-        conn.close()
+        if promo['type'] == 'requests':
+            user = self._users.peek(user_id)
+            if user is not None:
+                user['daily_requests'] -= promo['requests']
+        else:
+            self._update_cached_user(user_id, **fields)
         
         return {"success": True, "promo": dict(promo)}
     
@@ -261,58 +593,177 @@ class DatabaseService:
     
     def save_message(self, user_id: int, role: str, content: str):
         """Сохранить сообщение в историю"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
+        self._write("""
             INSERT INTO conversations (user_id, role, content)
             VALUES (?, ?, ?)
         """, (user_id, role, content))
         
-        conn.commit()
-        conn.close()
+        # id появится только после записи в базу
+        self._history.append(user_id, (None, role, content))
     
-    def get_conversation_history(self, user_id: int, limit: int = MAX_HISTORY):
-        """Получить историю диалога"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+    def get_conversation_history(self, user_id: int, limit: int = MAX_HISTORY, after_id: int = None):
+        """
+        Получить историю диалога
+        
+        Args:
+            user_id: ID пользователя
+            limit: сколько последних сообщений вернуть
+            after_id: только сообщения новее этого id (старые уже в кратком содержании)
+        """
+        if limit <= HISTORY_CACHE_TURNS:
+            turns = self._history.get(user_id)
+            if turns is None:
+                turns = self._load_history(user_id, HISTORY_CACHE_TURNS)
+                self._history.load(user_id, turns)
+        else:
+            turns = self._load_history(user_id, limit, after_id)
         
-        cursor.execute("""
-            SELECT role, content FROM conversations
-            WHERE user_id = ?
+        if after_id is not None:
+            # id = None — сообщение ещё в очереди записи, значит новее любого записанного
+            turns = [turn for turn in turns if turn[0] is None or turn[0] > after_id]
+        
+        return [(role, content) for _, role, content in turns[-limit:]] if limit > 0 else []
+    
+    def _load_history(self, user_id: int, limit: int, after_id: int = None) -> list:
+        """Последние реплики из базы: [(id, role, content), ...] (старые -> новые)"""
+        self.flush()  # история должна включать ещё не записанные сообщения
+        
+        cursor = self._connect().execute("""
+            SELECT id, role, content FROM conversations
+            WHERE user_id = ? AND id > ?
             ORDER BY id DESC
             LIMIT ?
-        """, (user_id, limit))
+        """, (user_id, after_id or 0, limit))
         
         messages = cursor.fetchall()
-        conn.close()
         
         # Возвращаем в правильном порядке (старые -> новые)
-        return [(msg['role'], msg['content']) for msg in reversed(messages)]
+        return [(msg['id'], msg['role'], msg['content']) for msg in reversed(messages)]
     
     def clear_history(self, user_id: int):
         """Очистить историю диалога"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Через ту же очередь, чтобы не обогнать ещё не записанные сообщения
+        self._write("DELETE FROM conversations WHERE user_id = ?", (user_id,))
         
-        cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+        self._write("DELETE FROM conversation_summaries WHERE user_id = ?", (user_id,))
         
-        conn.commit()
-        conn.close()
+        # История теперь пустая — кэшируем это, без лишнего чтения из базы
+        self._history.load(user_id, [])
+        self._summaries.set(user_id, {})
         logger.info(f"🗑️ История очищена для {user_id}")
     
     def get_user_stats(self, user_id: int):
         """Статистика пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        self.flush()
         
-        cursor.execute("""
+        cursor = self._connect().execute("""
             SELECT COUNT(*) as total FROM conversations
             WHERE user_id = ? AND role = 'user'
         """, (user_id,))
         
         total = cursor.fetchone()[0]
-        conn.close()
         
-        return {"total_messages": total}
\ No newline at end of file
+        return {"total_messages": total}
+    
+    # ========================================
+    # КРАТКОЕ СОДЕРЖАНИЕ ДИАЛОГОВ
+    # ========================================
+    
+    def get_summary(self, user_id: int):
+        """Краткое содержание старой части диалога: {"summary", "last_message_id"} или None"""
+        summary = self._summaries.get(user_id)
+        if summary is None:
+            row = self._connect().execute("""
+                SELECT summary, last_message_id FROM conversation_summaries
+                WHERE user_id = ?
+            """, (user_id,)).fetchone()
+            
+            summary = dict(row) if row else {}
+            self._summaries.set(user_id, summary)
+        
+        return dict(summary) if summary else None
+    
+    def save_summary(self, user_id: int, summary: str, last_message_id: int) -> bool:
+        """
+        Сохранить краткое содержание сообщений до last_message_id включительно
+        
+        Returns:
+            bool: False — история за это время была очищена, содержание устарело
+        """
+        self.flush()
+        
+        with self._connect() as conn:
+            saved = conn.execute("""
+                INSERT OR REPLACE INTO conversation_summaries (user_id, summary, last_message_id, updated_at)
+                SELECT ?, ?, ?, ?
+                WHERE EXISTS (SELECT 1 FROM conversations WHERE id = ? AND user_id = ?)
+            """, (user_id, summary, last_message_id, datetime.now().isoformat(),
+                  last_message_id, user_id)).rowcount
+        
+        if not saved:
+            return False
+        
+        self._summaries.set(user_id, {"summary": summary, "last_message_id": last_message_id})
+        
+        # В кэше истории у свежих реплик нет id — перечитаем, чтобы отсечь вошедшие в содержание
+        self._history.drop(user_id)
+        return True
+    
+    def count_messages_after(self, user_id: int, after_id: int = None) -> int:
+        """Сколько сообщений пользователя новее after_id (без ещё не записанных)"""
+        cursor = self._connect().execute("""
+            SELECT COUNT(*) FROM conversations
+            WHERE user_id = ? AND id > ?
+        """, (user_id, after_id or 0))
+        
+        return cursor.fetchone()[0]
+    
+    def get_messages_after(self, user_id: int, after_id: int = None, limit: int = 100) -> list:
+        """Самые старые сообщения новее after_id: [(id, role, content), ...] (старые -> новые)"""
+        self.flush()
+        
+        cursor = self._connect().execute("""
+            SELECT id, role, content FROM conversations
+            WHERE user_id = ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+        """, (user_id, after_id or 0, limit))
+        
+        return [(msg['id'], msg['role'], msg['content']) for msg in cursor.fetchall()]
+    
+    # ========================================
+    # КЭШ ОТВЕТОВ
+    # ========================================
+    
+    def get_cached_response(self, key: str):
+        """Сохранённый ответ по ключу запроса (None — нет или устарел)"""
+        cursor = self._connect().execute("""
+            SELECT response FROM response_cache
+            WHERE key = ? AND expires_at > ?
+        """, (key, time.time()))
+        
+        row = cursor.fetchone()
+        return row['response'] if row else None
+    
+    def save_cached_response(self, key: str, response: str, ttl: float):
+        """Сохранить ответ в кэш на ttl секунд"""
+        self._write("""
+            INSERT OR REPLACE INTO response_cache (key, response, expires_at)
+            VALUES (?, ?, ?)
+        """, (key, response, time.time() + ttl))
+        
+        # Периодическая чистка — в той же очереди записи, обработчик её не ждёт
+        now = time.monotonic()
+        if now >= self._response_purge_at:
+            self._response_purge_at = now + RESPONSE_CACHE_PURGE_INTERVAL
+            self._write(PURGE_EXPIRED_RESPONSES, (time.time(),))
+            self._write(PURGE_EXTRA_RESPONSES, (RESPONSE_CACHE_DB_MAX_ROWS,))
+    
+    def purge_response_cache(self):
+        """Удалить устаревшие ответы и старейшие сверх RESPONSE_CACHE_DB_MAX_ROWS"""
+        with self._connect() as conn:
+            deleted = conn.execute(PURGE_EXPIRED_RESPONSES, (time.time(),)).rowcount
+            deleted += conn.execute(PURGE_EXTRA_RESPONSES, (RESPONSE_CACHE_DB_MAX_ROWS,)).rowcount
+        
+        if deleted:
+            logger.info(f"🗑️ Удалено ответов из кэша: {deleted}")
\ No newline at end of file
@@ -1,14 +1,42 @@
 # gemini_api.py - модуль работы с Gemini API (ИСПРАВЛЕНО)
+import asyncio
+import hashlib
+import json
+import re
+import time
+from datetime import timedelta
 import google.generativeai as genai
-from config import GEMINI_API_KEY, GEMINI_MODEL, BOT_PERSONALITY, MAX_MESSAGE_LENGTH
+from google.generativeai import caching
+from utils.singleflight import SingleFlight
+from scheduler import PriorityScheduler
+from prompt_builder import PromptBuilder
+from metrics import timed, record_error, record_tokens
+from rate_limiter import (AdaptiveRateLimiter, CircuitBreaker, is_rate_limited, is_transient,
+                          retry_after_seconds, backoff_delay)
+from config import (GEMINI_API_KEY, GEMINI_MODEL, BOT_PERSONALITY, MAX_MESSAGE_LENGTH,
+                    GEMINI_MAX_CONCURRENT, GEMINI_TIMEOUT, GEMINI_MAX_RETRIES, GEMINI_RETRY_MAX_DELAY,
+                    RESPONSE_CACHE_WITH_HISTORY, SUMMARY_MAX_TOKENS,
+                    GEMINI_CONTEXT_CACHE, GEMINI_CONTEXT_CACHE_TTL, GEMINI_RPM, GEMINI_TPM)
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class GeminiError(Exception):
+    """Ошибка генерации; текст исключения можно показать пользователю"""
+
+
 class GeminiAPI:
-    def __init__(self):
-        """Инициализация Gemini"""
+    def __init__(self, response_cache=None, share: float = 1.0):
+        """
+        Инициализация Gemini
+        
+        Args:
+            response_cache: ResponseCache для повторяющихся вопросов (None — без кэша)
+            share: доля лимитов API на этот процесс (при нескольких воркерах — 1 / число воркеров)
+        """
+        self.response_cache = response_cache
+        
         try:
             genai.configure(api_key=GEMINI_API_KEY)
             
@@ -20,86 +48,502 @@ class GeminiAPI:
                 "max_output_tokens": 2048,
             }
             
-            # Инициализация модели с настройками
+            # Сборка промпта с историей в пределах бюджета токенов
+            self.prompts = PromptBuilder()
+            
+            # Личность бота — системная инструкция модели, собирается один раз
             self.model = genai.GenerativeModel(
+                model_name=GEMINI_MODEL,
+                generation_config=self.generation_config,
+                system_instruction=self.prompts.system_instruction
+            )
+            self._persona_model = self.model
+            
+            # Служебные запросы (сжатие истории) — без личности бота
+            self.plain_model = genai.GenerativeModel(
                 model_name=GEMINI_MODEL,
                 generation_config=self.generation_config
             )
             
-            logger.info(f"✅ Gemini модель {GEMINI_MODEL} инициализирована")
+            # Системная инструкция в кэше контекста Gemini (не передаётся с каждым запросом)
+            self._context_cache = None
+            self._context_cache_renew_at = 0.0
+            if GEMINI_CONTEXT_CACHE:
+                self._create_context_cache()
+            
+            # Очередь запросов: общий лимит параллельности, приоритет по тарифам
+            self.scheduler = PriorityScheduler(max(1, round(GEMINI_MAX_CONCURRENT * share)))
+            
+            # Лимиты RPM/TPM и отключение при сбоях API
+            self.limiter = AdaptiveRateLimiter(GEMINI_RPM * share, GEMINI_TPM * share)
+            self.breaker = CircuitBreaker()
             
+            # Одинаковые одновременные запросы — одна генерация на всех
+            self._inflight = SingleFlight()
+            
+            logger.info(f"✅ Gemini модель {GEMINI_MODEL} инициализирована")
+        
         except Exception as e:
             logger.error(f"❌ Ошибка инициализации Gemini: {e}")
             raise
     
-    def generate_response(self, message: str, history: list = None) -> str:
+    def _select_history(self, history: list = None, plan: str = 'free') -> list:
+        """Реплики истории, которые попадут в промпт (по бюджету токенов тарифа)"""
+        return self.prompts.select_history(history, plan)
+    
+    def _request_key(self, message: str, history: list = None, plan: str = 'free') -> str:
+        """Ключ запроса: нормализованный вопрос + история в промпте + настройки модели"""
+        turns = self._select_history(history, plan)
+        
+        # "Привет!!", "привет" и " ПРИВЕТ " — один и тот же вопрос
+        normalized = re.sub(r'\s+', ' ', message.casefold()).strip().rstrip('.!?…) ')
+        
+        payload = json.dumps(
+            [normalized, turns, BOT_PERSONALITY, GEMINI_MODEL, self.generation_config],
+            ensure_ascii=False,
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _cache_key(self, key: str, history: list = None, plan: str = 'free'):
+        """Ключ для кэша ответов или None, если этот ответ кэшировать нельзя"""
+        if self.response_cache is None:
+            return None
+        
+        if self._select_history(history, plan) and not RESPONSE_CACHE_WITH_HISTORY:
+            return None
+        
+        return key
+    
+    def _build_prompt(self, message: str, history: list = None, plan: str = 'free') -> list:
+        """Сборка запроса: история + текущее сообщение (личность бота — в системной инструкции)"""
+        return self.prompts.build(message, history, plan)
+    
+    def _create_context_cache(self):
+        """Положить системную инструкцию в кэш контекста Gemini (при ошибке — работаем без него)"""
+        try:
+            cache = caching.CachedContent.create(
+                model=GEMINI_MODEL,
+                display_name="bot-personality",
+                system_instruction=self.prompts.system_instruction,
+                ttl=timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL)
+            )
+            self.model = genai.GenerativeModel.from_cached_content(
+                cache,
+                generation_config=self.generation_config
+            )
+            self._context_cache = cache
+            self._context_cache_renew_at = time.monotonic() + GEMINI_CONTEXT_CACHE_TTL / 2
+            logger.info(f"🧊 Кэш контекста Gemini создан: {cache.name}")
+        
+        except Exception as e:
+            # Например, инструкция короче минимального размера кэша для модели
+            logger.warning(f"⚠️ Кэш контекста Gemini недоступен, инструкция идёт с каждым запросом: {e}")
+            self.model = self._persona_model
+            self._context_cache = None
+    
+    async def _refresh_context_cache(self):
+        """Продлить кэш контекста, пока он не истёк"""
+        if self._context_cache is None or time.monotonic() < self._context_cache_renew_at:
+            return
+        
+        # Одно продление на всех, даже если запросы пришли одновременно
+        self._context_cache_renew_at = time.monotonic() + GEMINI_CONTEXT_CACHE_TTL / 2
+        loop = asyncio.get_running_loop()
+        
+        try:
+            await loop.run_in_executor(
+                None,
+                lambda: self._context_cache.update(ttl=timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL))
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось продлить кэш контекста Gemini, создаю заново: {e}")
+            await loop.run_in_executor(None, self._create_context_cache)
+    
+    def _extract_text(self, response) -> str:
+        """Достаёт текст из ответа модели и обрезает слишком длинные ответы"""
+        # Проверяем, есть ли ответ
+        if not response or not response.text:
+            logger.warning("⚠️ Gemini вернул пустой ответ")
+            raise GeminiError("😔 Извините, не смог сгенерировать ответ. Попробуйте перефразировать вопрос.")
+        
+        ai_response = response.text.strip()
+        
+        # Обрезаем слишком длинные ответы
+        if len(ai_response) > MAX_MESSAGE_LENGTH:
+            ai_response = ai_response[:MAX_MESSAGE_LENGTH] + "\n\n...(ответ обрезан)"
+        
+        logger.info(f"✅ Ответ получен ({len(ai_response)} символов)")
+        return ai_response
+    
+    def _error_message(self, e: Exception) -> str:
+        """Понятное пользователю сообщение об ошибке Gemini"""
+        if isinstance(e, GeminiError):
+            return str(e)
+        
+        logger.error(f"❌ Ошибка Gemini API: {e}")
+        
+        if is_rate_limited(e):
+            return "⚠️ Превышен лимит запросов к Gemini. Попробуйте позже."
+        
+        if is_transient(e) and not isinstance(e, asyncio.TimeoutError):
+            return "🔧 Gemini временно недоступен. Попробуйте через минуту."
+        
+        # Детальные сообщения об ошибках
+        error_msg = str(e).lower()
+        
+        if "api key" in error_msg or "invalid" in error_msg:
+            return "❌ Ошибка API ключа. Проверьте GEMINI_API_KEY в config.py"
+        
+        elif "quota" in error_msg or "limit" in error_msg:
+            return "⚠️ Превышен лимит запросов к Gemini. Попробуйте позже."
+        
+        elif "timeout" in error_msg:
+            return "⏱️ Превышено время ожидания. Попробуйте ещё раз."
+        
+        elif "blocked" in error_msg or "safety" in error_msg:
+            return "🛡️ Ваш запрос заблокирован фильтрами безопасности Gemini. Попробуйте перефразировать."
+        
+        else:
+            return f"😔 Ошибка при обработке запроса: {str(e)[:100]}"
+    
+    def _estimate_tokens(self, prompt: str) -> int:
+        """Примерный размер запроса в токенах (для лимита TPM)"""
+        return self.prompts.estimator.estimate(prompt)
+    
+    def _record_usage(self, response, prompt: str, estimate: int, plan: str = 'free'):
+        """Записать размер промпта и сообщить ограничителю фактический расход токенов"""
+        self.prompts.report(prompt, response, plan)
+        record_tokens(plan, response)
+        
+        try:
+            actual = response.usage_metadata.total_token_count
+        except Exception:
+            return  # в ответе нет статистики — остаётся оценка
+        
+        self.limiter.record_usage(estimate, actual)
+    
+    async def _call(self, request, estimate: int, deadline: float):
+        """
+        Запрос к Gemini с лимитом частоты, повторами и предохранителем
+        
+        При 429 ждёт столько, сколько просит API (retry-after), при временных
+        сбоях (500/503/504, таймаут) — паузу со случайным разбросом; повторы
+        не выходят за deadline. Пока предохранитель открыт, сразу отвечает ошибкой.
+        
+        Args:
+            request: функция без аргументов, возвращающая корутину запроса
+            estimate: примерный размер запроса в токенах
+            deadline: время event loop, после которого ответ уже не нужен
+        """
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        
+        while True:
+            if not self.breaker.allow():
+                raise GeminiError("🔧 Gemini временно недоступен. Попробуйте через минуту.")
+            
+            # API просит подождать дольше, чем у нас есть времени
+            if self.limiter.blocked_for() >= deadline - loop.time():
+                raise GeminiError("⚠️ Превышен лимит запросов к Gemini. Попробуйте позже.")
+            
+            try:
+                with timed("gemini_rate_wait"):
+                    await asyncio.wait_for(
+                        self.limiter.acquire(estimate),
+                        timeout=max(0.0, deadline - loop.time())
+                    )
+            except asyncio.TimeoutError:
+                raise GeminiError("⚠️ Превышен лимит запросов к Gemini. Попробуйте позже.")
+            
+            try:
+                with timed("gemini_api"):
+                    result = await asyncio.wait_for(request(), timeout=max(0.0, deadline - loop.time()))
+            
+            except Exception as e:
+                record_error("gemini", e)
+                if is_rate_limited(e):
+                    retry_after = retry_after_seconds(e)
+                    self.limiter.on_rate_limited(retry_after)
+                    delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                
+                elif is_transient(e):
+                    self.breaker.record_failure()
+                    delay = backoff_delay(attempt)
+                
+                else:
+                    # Ошибка самого запроса: API при этом работает
+                    self.breaker.record_success()
+                    raise
+                
+                if attempt >= GEMINI_MAX_RETRIES or delay > min(GEMINI_RETRY_MAX_DELAY, deadline - loop.time()):
+                    raise
+                
+                attempt += 1
+                logger.warning(f"🔁 Повтор запроса к Gemini через {delay:.1f} сек ({type(e).__name__})")
+                await asyncio.sleep(delay)
+                continue
+            
+            self.breaker.record_success()
+            self.limiter.on_success()
+            return result
+    
+    async def generate_response_async(self, message: str, history: list = None,
+                                      plan: str = 'free', user_id: int = None) -> str:
         """
-        Генерация ответа от Gemini
+        Асинхронная генерация ответа, не блокирует event loop
+        
+        Одновременно выполняется не больше GEMINI_MAX_CONCURRENT запросов,
+        при перегрузке очередь обслуживает платные тарифы чаще (см. PriorityScheduler);
+        каждый запрос ограничен GEMINI_TIMEOUT секундами. Отмена задачи
+        (asyncio.CancelledError) прерывает ожидание ответа. Одинаковые
+        запросы, пришедшие одновременно, получают один общий ответ.
         
         Args:
             message: сообщение пользователя
             history: история диалога [(role, content), ...]
+            plan: тариф пользователя (приоритет в очереди)
+            user_id: ID пользователя (очередь внутри тарифа — по кругу)
         
         Returns:
             str: ответ AI
+        
+        Raises:
+            GeminiError: текст ошибки для пользователя
         """
+        key = self._request_key(message, history, plan)
+        
+        # Такой вопрос уже задавали — отвечаем из кэша
+        cache_key = self._cache_key(key, history, plan)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info("⚡ Ответ из кэша")
+                return cached
+        
+        if self._inflight.get(key) is not None:
+            logger.info("🔗 Такой же запрос уже выполняется — ждём его ответ")
+        
+        return await self._inflight.do(
+            key, lambda: self._generate(message, history, cache_key, plan, user_id)
+        )
+    
+    async def _generate(self, message: str, history: list, cache_key,
+                        plan: str = 'free', user_id: int = None) -> str:
+        """Один запрос к Gemini (через очередь планировщика и с таймаутом)"""
+        with timed("prompt_build"):
+            contents = self._build_prompt(message, history, plan)
+            prompt_text = self.prompts.prompt_text(contents)
+            estimate = self._estimate_tokens(prompt_text)
+        loop = asyncio.get_running_loop()
+        
         try:
-            # Формируем системный промпт
-            system_prompt = "\n".join(BOT_PERSONALITY)
-            
-            # Формируем контекст беседы
-            conversation_parts = [system_prompt]
+            await self._refresh_context_cache()
             
-            # Добавляем историю (последние N сообщений)
-            if history:
-                for role, content in history[-6:]:  # берем последние 6 сообщений
-                    prefix = "Пользователь" if role == "user" else "Ассистент"
-                    conversation_parts.append(f"{prefix}: {content}")
+            async with self.scheduler.slot(plan, user_id):
+                # Время в очереди не входит в таймаут
+                deadline = loop.time() + GEMINI_TIMEOUT
+                logger.info("🔄 Отправка запроса к Gemini...")
+                response = await self._call(
+                    lambda: self.model.generate_content_async(contents),
+                    estimate,
+                    deadline
+                )
             
-            # Добавляем текущее сообщение
-            conversation_parts.append(f"Пользователь: {message}")
-            conversation_parts.append("Ассистент:")
+            self._record_usage(response, prompt_text, estimate, plan)
+            ai_response = self._extract_text(response)
             
-            full_prompt = "\n\n".join(conversation_parts)
+            if cache_key is not None:
+                self.response_cache.set(cache_key, ai_response)
             
-            # Генерируем ответ с таймаутом
-            logger.info("🔄 Отправка запроса к Gemini...")
-            response = self.model.generate_content(full_prompt)
-            
-            # Проверяем, есть ли ответ
-            if not response or not response.text:
-                logger.warning("⚠️ Gemini вернул пустой ответ")
-                return "😔 Извините, не смог сгенерировать ответ. Попробуйте перефразировать вопрос."
-            
-            ai_response = response.text.strip()
-            
-            # Обрезаем слишком длинные ответы
-            if len(ai_response) > MAX_MESSAGE_LENGTH:
-                ai_response = ai_response[:MAX_MESSAGE_LENGTH] + "\n\n...(ответ обрезан)"
-            
-            logger.info(f"✅ Ответ получен ({len(ai_response)} символов)")
             return ai_response
-            
+        
+        except asyncio.TimeoutError:
+            logger.warning(f"⏱️ Gemini не ответил за {GEMINI_TIMEOUT} сек")
+            raise GeminiError("⏱️ Превышено время ожидания. Попробуйте ещё раз.")
+        
+        except GeminiError:
+            raise
+        
         except Exception as e:
-            logger.error(f"❌ Ошибка Gemini API: {e}")
-            
-            # Детальные сообщения об ошибках
-            error_msg = str(e).lower()
-            
-            if "api key" in error_msg or "invalid" in error_msg:
-                return "❌ Ошибка API ключа. Проверьте GEMINI_API_KEY в config.py"
-            
-            elif "quota" in error_msg or "limit" in error_msg:
-                return "⚠️ Превышен лимит запросов к Gemini. Попробуйте позже."
+            raise GeminiError(self._error_message(e)) from e
+    
+    async def stream_response_async(self, message: str, history: list = None,
+                                    plan: str = 'free', user_id: int = None):
+        """
+        Потоковая генерация: отдаёт текст кусками по мере готовности
+        
+        Ограничения те же, что у generate_response_async: очередь
+        планировщика и GEMINI_TIMEOUT на весь ответ целиком.
+        Если такой же запрос уже выполняется, ответ придёт одним куском,
+        когда он завершится.
+        
+        Args:
+            message: сообщение пользователя
+            history: история диалога [(role, content), ...]
+            plan: тариф пользователя (приоритет в очереди)
+            user_id: ID пользователя
+        
+        Yields:
+            str: очередной кусок ответа
+        
+        Raises:
+            GeminiError: текст ошибки для пользователя
+        """
+        key = self._request_key(message, history, plan)
+        
+        # Такой вопрос уже задавали — отдаём ответ из кэша целиком
+        cache_key = self._cache_key(key, history, plan)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info("⚡ Ответ из кэша")
+                yield cached
+                return
+        
+        # Такой же запрос уже генерируется — ждём его ответ
+        shared = self._inflight.get(key)
+        if shared is not None:
+            logger.info("🔗 Такой же запрос уже выполняется — ждём его ответ")
+            yield await self._inflight.wait(shared)
+            return
+        
+        flight = self._inflight.begin(key)
+        parts = []
+        
+        try:
+            async for text in self._generate_stream(message, history, plan, user_id):
+                parts.append(text)
+                yield text
+        
+        except GeminiError as e:
+            self._inflight.finish(flight, error=e)
+            raise
+        
+        except BaseException:
+            # Генерацию прервали (отмена, закрытие генератора) — ожидающим сообщаем об ошибке
+            self._inflight.finish(flight, error=GeminiError("😔 Ответ не был получен. Попробуйте ещё раз."))
+            raise
+        
+        ai_response = "".join(parts).strip()
+        self._inflight.finish(flight, result=ai_response)
+        
+        if cache_key is not None:
+            self.response_cache.set(cache_key, ai_response)
+    
+    async def _generate_stream(self, message: str, history: list,
+                               plan: str = 'free', user_id: int = None):
+        """Один потоковый запрос к Gemini (через очередь планировщика и с таймаутом)"""
+        with timed("prompt_build"):
+            contents = self._build_prompt(message, history, plan)
+            prompt_text = self.prompts.prompt_text(contents)
+            estimate = self._estimate_tokens(prompt_text)
+        loop = asyncio.get_running_loop()
+        total = 0
+        
+        async def open_stream():
+            # Повторять запрос можно только до первого куска ответа
+            response = await self.model.generate_content_async(contents, stream=True)
+            pieces = response.__aiter__()
+            try:
+                first = await pieces.__anext__()
+            except StopAsyncIteration:
+                first = None
+            return response, pieces, first
+        
+        try:
+            await self._refresh_context_cache()
             
-            elif "timeout" in error_msg:
-                return "⏱️ Превышено время ожидания. Попробуйте ещё раз."
+            async with self.scheduler.slot(plan, user_id):
+                # Время в очереди не входит в таймаут
+                deadline = loop.time() + GEMINI_TIMEOUT
+                logger.info("🔄 Отправка потокового запроса к Gemini...")
+                response, pieces, chunk = await self._call(open_stream, estimate, deadline)
+                
+                while chunk is not None:
+                    text = chunk.text
+                    if total == 0:
+                        text = text.lstrip()
+                    
+                    # Обрезаем слишком длинные ответы
+                    if total + len(text) > MAX_MESSAGE_LENGTH:
+                        yield text[:MAX_MESSAGE_LENGTH - total] + "\n\n...(ответ обрезан)"
+                        total = MAX_MESSAGE_LENGTH
+                        break
+                    
+                    if text:
+                        total += len(text)
+                        yield text
+                    
+                    try:
+                        chunk = await asyncio.wait_for(
+                            pieces.__anext__(),
+                            timeout=max(0.0, deadline - loop.time())
+                        )
+                    except StopAsyncIteration:
+                        chunk = None
             
-            elif "blocked" in error_msg or "safety" in error_msg:
-                return "🛡️ Ваш запрос заблокирован фильтрами безопасности Gemini. Попробуйте перефразировать."
+            self._record_usage(response, prompt_text, estimate, plan)
+        
+        except asyncio.TimeoutError:
+            logger.warning(f"⏱️ Gemini не ответил за {GEMINI_TIMEOUT} сек")
+            raise GeminiError("⏱️ Превышено время ожидания. Попробуйте ещё раз.")
+        
+        except GeminiError:
+            raise
+        
+        except Exception as e:
+            raise GeminiError(self._error_message(e)) from e
+        
+        if total == 0:
+            logger.warning("⚠️ Gemini вернул пустой ответ")
+            raise GeminiError("😔 Извините, не смог сгенерировать ответ. Попробуйте перефразировать вопрос.")
+        
+        logger.info(f"✅ Потоковый ответ получен ({total} символов)")
+    
+    async def summarize(self, previous: str, turns: list) -> str:
+        """
+        Краткое содержание части диалога (фоновая задача, низший приоритет в очереди)
+        
+        Args:
+            previous: прежнее краткое содержание (None — нет)
+            turns: реплики [(role, content), ...], которые нужно в него добавить
+        
+        Returns:
+            str: новое краткое содержание
+        
+        Raises:
+            GeminiError: не удалось получить ответ
+        """
+        prompt = self.prompts.build_summary(previous, turns)
+        estimate = self._estimate_tokens(prompt)
+        loop = asyncio.get_running_loop()
+        
+        try:
+            async with self.scheduler.slot('background'):
+                deadline = loop.time() + GEMINI_TIMEOUT
+                response = await self._call(
+                    lambda: self.plain_model.generate_content_async(
+                        prompt,
+                        generation_config={**self.generation_config,
+                                           "temperature": 0.2,
+                                           "max_output_tokens": SUMMARY_MAX_TOKENS}
+                    ),
+                    estimate,
+                    deadline
+                )
             
-            else:
-                return f"😔 Ошибка при обработке запроса: {str(e)[:100]}"
+            self._record_usage(response, prompt, estimate, 'summary')
+            return self._extract_text(response)
+        
+        except asyncio.TimeoutError:
+            raise GeminiError("⏱️ Превышено время ожидания.")
+        
+        except GeminiError:
+            raise
+        
+        except Exception as e:
+            raise GeminiError(self._error_message(e)) from e
     
     def test_connection(self) -> bool:
         """Тест подключения к Gemini"""
@@ -113,7 +557,7 @@ class GeminiAPI:
             else:
                 logger.error("❌ Получен пустой ответ от Gemini")
                 return False
-                
+        
         except Exception as e:
             logger.error(f"❌ Тест не прошёл: {e}")
             
@@ -1,22 +1,40 @@
 # handlers.py - обработчики команд и сообщений
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from datetime import datetime
-from gemini_api import GeminiAPI
+import asyncio
+from gemini_api import GeminiAPI, GeminiError
 from firebase_service import DatabaseService
-from utils.formatter import format_code, escape_markdown
+from utils.formatter import to_markdown_v2
 from utils.chunker import split_message
-from config import FREE_DAILY_LIMIT, PREMIUM_PRICES, ADMIN_IDS
+from streaming import StreamingReply, retry_seconds
+from response_cache import ResponseCache
+from summarizer import ConversationSummarizer
+from user_locks import UserLocks, per_user
+from metrics import timed, timed_handler, record_error, register_bot
+from tracing import traced, current_trace_id, PROFILER
+from config import (FREE_DAILY_LIMIT, PREMIUM_PRICES, ADMIN_IDS, STREAM_RESPONSES, RESPONSE_CACHE_ENABLED,
+                    MAX_HISTORY, HISTORY_FETCH_LIMIT, SUMMARY_ENABLED, PROFILER_SECONDS, PROFILER_MAX_SECONDS)
 import logging
 
 logger = logging.getLogger(__name__)
 
 
 class BotHandlers:
-    def __init__(self):
-        self.gemini = GeminiAPI()
-        self.db = DatabaseService()
+    def __init__(self, gemini_share: float = 1.0, db_path: str = None):
+        """
+        gemini_share — доля лимитов Gemini на процесс (несколько воркеров, см. sharding.py);
+        db_path — файл базы (None — DATABASE_PATH, другой файл — для нагрузочного теста)
+        """
+        self.db = DatabaseService(db_path)
+        self.response_cache = ResponseCache(self.db) if RESPONSE_CACHE_ENABLED else None
+        self.gemini = GeminiAPI(response_cache=self.response_cache, share=gemini_share)
+        self.summarizer = ConversationSummarizer(self.db, self.gemini) if SUMMARY_ENABLED else None
+        self.user_locks = UserLocks()  # сообщения одного пользователя — по очереди
+        register_bot(self)  # очереди и кэши в /metrics
     
+    @traced("start")
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /start"""
         user_id = update.effective_user.id
@@ -78,20 +96,25 @@ class BotHandlers:
 📊 Осталось запросов: {remaining}/{FREE_DAILY_LIMIT}
 💡 Хотите больше? → /upgrade"""
     
+    @traced("message")
+    @per_user
+    @timed_handler("message")
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка текстовых сообщений"""
         user_id = update.effective_user.id
         message_text = update.message.text
         
         # Получение пользователя
-        user = self.db.get_user(user_id)
+        with timed("db_user"):
+            user = self.db.get_user(user_id)
         if not user:
             await update.message.reply_text("⚠️ Нажмите /start для начала")
             return
         
-        # Проверка лимита запросов
-        remaining = self.db.get_remaining_requests(user_id)
-        if remaining <= 0:
+        # Проверка и списание лимита одним атомарным запросом
+        with timed("db_quota"):
+            quota = self.db.try_consume(user_id)
+        if not quota['allowed']:
             keyboard = [[InlineKeyboardButton("⭐ Купить Premium", callback_data="upgrade")]]
             await update.message.reply_text(
                 "❌ Ваш дневной лимит исчерпан.\n\n"
@@ -100,51 +123,143 @@ class BotHandlers:
             )
             return
         
-        # Показать "печатает..."
-        await update.message.chat.send_action("typing")
+        # Показать "печатает..." — необязательно: сбой сети здесь не должен стоить запроса
+        try:
+            await update.message.chat.send_action("typing")
+        except TelegramError as e:
+            logger.warning(f"⚠️ Не удалось показать \"печатает...\": {e}")
+        
+        # Приоритет в очереди к Gemini — по действующему тарифу
+        plan = user['plan'] if quota['remaining'] is None else 'free'
         
+        ai_response = None
+        undelivered = []  # части потокового ответа, которые Telegram не принял
         try:
-            # Получить историю диалога
-            history = self.db.get_conversation_history(user_id)
+            # Получить историю диалога (в потоке: при промахе кэша ждёт фоновую запись)
+            with timed("db_history"):
+                history = await asyncio.to_thread(self._get_history, user_id, plan)
             
-            # Генерация ответа
-            ai_response = self.gemini.generate_response(message_text, history)
+            # Генерация ответа (не блокирует остальных пользователей)
+            try:
+                if STREAM_RESPONSES:
+                    # Ответ появляется в чате по мере генерации
+                    with timed("stream"):
+                        ai_response, undelivered = await self._stream_reply(update, message_text, history, plan)
+                else:
+                    with timed("generate"):
+                        ai_response = await self.gemini.generate_response_async(
+                            message_text, history, plan=plan, user_id=user_id
+                        )
+            except GeminiError as e:
+                # Ответа нет — списанный запрос возвращаем
+                self.db.refund_request(user_id, quota)
+                await update.message.reply_text(str(e))
+                return
             
-            # Форматирование ответа
-            formatted_response = format_code(ai_response)
+            # Сохранение в историю — до отправки: сбой Telegram не должен терять готовый ответ
+            with timed("db_save"):
+                self.db.save_message(user_id, 'user', message_text)
+                self.db.save_message(user_id, 'assistant', ai_response)
             
-            # Разбивка на части, если слишком длинный
-            chunks = split_message(formatted_response)
+            # Длинный диалог — сжимаем старую часть в фоне
+            if self.summarizer is not None:
+                self.summarizer.schedule(user_id)
             
-            # Отправка ответа
-            for chunk in chunks:
-                await update.message.reply_text(
-                    chunk,
-                    parse_mode='Markdown',
-                    disable_web_page_preview=True
-                )
+            if not STREAM_RESPONSES:
+                await self._send_reply(update, ai_response)
             
-            # Сохранение в историю
-            self.db.save_message(user_id, 'user', message_text)
-            self.db.save_message(user_id, 'assistant', ai_response)
+            # Потоковая отправка оборвалась — досылаем оставшиеся части обычными сообщениями
+            for chunk in undelivered:
+                await self._send_chunk(update, chunk)
             
-            # Уменьшение лимита для free
-            if user['plan'] == 'free':
-                self.db.use_request(user_id)
-                
-                # Показать оставшиеся запросы
-                remaining = self.db.get_remaining_requests(user_id)
-                if remaining <= 3:
-                    await update.message.reply_text(
-                        f"⚠️ Осталось запросов сегодня: {remaining}"
-                    )
+            # Показать оставшиеся запросы (для free)
+            remaining = quota['remaining']
+            if remaining is not None and remaining <= 3:
+                await update.message.reply_text(
+                    f"⚠️ Осталось запросов сегодня: {remaining}"
+                )
         
         except Exception as e:
-            logger.error(f"Ошибка обработки сообщения: {e}")
+            logger.error(f"Ошибка обработки сообщения [{current_trace_id()}]: {e}")
+            record_error("message", e)
+            if ai_response is None:
+                self.db.refund_request(user_id, quota)
             await update.message.reply_text(
                 "😔 Произошла ошибка. Попробуйте ещё раз или /clear историю."
             )
     
+    def _get_history(self, user_id: int, plan: str) -> list:
+        """История для промпта: краткое содержание старой части + свежие реплики"""
+        limit = HISTORY_FETCH_LIMIT.get(plan, MAX_HISTORY)
+        
+        summary = self.db.get_summary(user_id) if SUMMARY_ENABLED else None
+        if not summary:
+            return self.db.get_conversation_history(user_id, limit)
+        
+        history = self.db.get_conversation_history(user_id, limit, after_id=summary['last_message_id'])
+        return [('summary', summary['summary'])] + history
+    
+    async def _stream_reply(self, update: Update, message_text: str, history: list,
+                            plan: str = 'free') -> tuple:
+        """
+        Потоковая генерация с постепенным обновлением сообщения
+        
+        Returns:
+            tuple: (полный текст ответа, части, которые не удалось отправить)
+        """
+        reply = StreamingReply(update.message)
+        stream = self.gemini.stream_response_async(
+            message_text, history, plan=plan, user_id=update.effective_user.id
+        )
+        
+        try:
+            async for piece in stream:
+                await reply.feed(piece)
+        finally:
+            # Даже при ошибке показываем то, что успело сгенерироваться
+            await reply.finish()
+        
+        return reply.text, reply.undelivered
+    
+    async def _send_reply(self, update: Update, ai_response: str):
+        """Отправка готового ответа частями"""
+        # Разбивка исходного Markdown на части (лимит Telegram — по видимому тексту)
+        with timed("split"):
+            chunks = split_message(ai_response)
+        
+        # Отправка ответа: каждая часть — отдельно отформатированный MarkdownV2
+        for chunk in chunks:
+            await self._send_chunk(update, chunk)
+    
+    async def _send_chunk(self, update: Update, chunk: str):
+        """
+        Одна часть ответа: MarkdownV2 (проверенный заранее), при отказе Telegram —
+        эта же часть обычным текстом; остальные части это не затрагивает
+        """
+        with timed("format"):
+            formatted = to_markdown_v2(chunk)
+        
+        for parse_mode, body in (('MarkdownV2', formatted), (None, chunk)):
+            try:
+                with timed("reply"):
+                    await self._reply_with_retry(update, body, parse_mode)
+                return
+            except BadRequest as e:
+                record_error("reply", e)
+                if parse_mode is None:
+                    raise
+                logger.warning(f"⚠️ MarkdownV2 не принят Telegram, отправляю без разметки: {e}")
+    
+    async def _reply_with_retry(self, update: Update, text: str, parse_mode):
+        """reply_text; если Telegram просит подождать — ждём и повторяем один раз"""
+        try:
+            await update.message.reply_text(text, parse_mode=parse_mode, disable_web_page_preview=True)
+        except RetryAfter as e:
+            await asyncio.sleep(retry_seconds(e))
+            await update.message.reply_text(text, parse_mode=parse_mode, disable_web_page_preview=True)
+    
+    @traced("promo")
+    @per_user
     async def promo_activate(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Активация промокода"""
         user_id = update.effective_user.id
@@ -175,6 +290,7 @@ class BotHandlers:
         else:
             await update.message.reply_text(f"❌ {result['error']}")
     
+    @traced("upgrade")
     async def upgrade(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Меню покупки премиума"""
         keyboard = [
@@ -204,18 +320,19 @@ class BotHandlers:
 
 Выберите план:"""
         
-        await update.message.reply_text(text, reply_markup=reply_markup)
+        await update.effective_message.reply_text(text, reply_markup=reply_markup)
     
+    @traced("stats")
     async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Статистика пользователя"""
         user_id = update.effective_user.id
         user = self.db.get_user(user_id)
         
         if not user:
-            await update.message.reply_text("⚠️ Нажмите /start")
+            await update.effective_message.reply_text("⚠️ Нажмите /start")
             return
         
-        stats = self.db.get_user_stats(user_id)
+        stats = await asyncio.to_thread(self.db.get_user_stats, user_id)
         remaining = self.db.get_remaining_requests(user_id)
         
         text = f"""📊 Ваша статистика
@@ -226,18 +343,50 @@ class BotHandlers:
 📊 Осталось запросов: {remaining if user['plan'] == 'free' else '∞'}
 📅 Регистрация: {user['created_at'][:10]}"""
         
-        await update.message.reply_text(text)
+        await update.effective_message.reply_text(text)
     
+    @traced("clear")
+    @per_user
     async def clear_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Очистка истории диалога"""
         user_id = update.effective_user.id
         self.db.clear_history(user_id)
+        if self.summarizer is not None:
+            self.summarizer.forget(user_id)
         
         await update.message.reply_text(
             "🗑️ История диалога очищена!\n\n"
             "Начнём с чистого листа 😊"
         )
     
+    @traced("profile")
+    async def profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Профилирование работающего бота (только для админов): /profile [секунд]"""
+        if update.effective_user.id not in ADMIN_IDS:
+            return
+        
+        try:
+            seconds = int(context.args[0]) if context.args else PROFILER_SECONDS
+        except ValueError:
+            seconds = PROFILER_SECONDS
+        seconds = max(1, min(seconds, PROFILER_MAX_SECONDS))
+        
+        if PROFILER.running:
+            await update.message.reply_text("🔬 Профилирование уже идёт")
+            return
+        
+        await update.message.reply_text(f"🔬 Профилирую {seconds} сек...")
+        
+        # Снимки стеков — в отдельном потоке, бот продолжает работать
+        path = await asyncio.to_thread(PROFILER.run, seconds)
+        if path is None:
+            await update.message.reply_text("🔬 Профилирование уже идёт")
+            return
+        
+        with open(path, 'rb') as file:
+            await update.message.reply_document(file, caption="🔥 folded stacks: flamegraph.pl / speedscope.app")
+    
+    @traced("button")
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка нажатий кнопок"""
         query = update.callback_query
@@ -0,0 +1,341 @@
+# metrics.py - метрики в формате Prometheus: время этапов, токены Gemini, очереди, кэши, ошибки
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+from tracing import CURRENT_TRACE
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы времени (секунды): от миллисекунды до минуты
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """{name="value",...} для строки метрики"""
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Счётчик, который только растёт (отдельное значение на каждый набор меток)"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}  # значения меток -> число
+    
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+    
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+    
+    def samples(self):
+        for label_values, value in self._values.items():
+            yield self.name, _labels(self.labels, label_values), value
+
+
+class Histogram:
+    """
+    Распределение времени: число наблюдений по корзинам, сумма и количество
+    
+    Перцентили (p50/p95/p99) считает Prometheus: histogram_quantile(0.95, ...).
+    Для логов и тестов есть приблизительный quantile() по тем же корзинам.
+    """
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # значения меток -> [счётчики корзин (+Inf последняя), сумма]
+    
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+    
+    def time(self, *label_values) -> "Timer":
+        """with histogram.time("stage"): ... — записать длительность блока"""
+        return Timer(self, label_values)
+    
+    def count(self, *label_values) -> int:
+        series = self._series.get(label_values)
+        return sum(series[0]) if series else 0
+    
+    def quantile(self, q: float, *label_values) -> float:
+        """Приблизительный перцентиль: линейно внутри корзины"""
+        series = self._series.get(label_values)
+        if not series:
+            return 0.0
+        
+        counts = series[0]
+        rank = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]  # выше последней границы точнее не скажешь
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+    
+    def samples(self):
+        for label_values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels(self.labels, label_values, f'le="{bound}"'), cumulative
+            cumulative += counts[-1]
+            yield f"{self.name}_bucket", _labels(self.labels, label_values, 'le="+Inf"'), cumulative
+            yield f"{self.name}_sum", _labels(self.labels, label_values), total
+            yield f"{self.name}_count", _labels(self.labels, label_values), cumulative
+
+
+class Timer:
+    """
+    Замер длительности блока with (perf_counter, без аллокаций сверх самого объекта)
+    
+    Если обновление трассируется (tracing.traced), замер становится и отрезком его трассы.
+    """
+    
+    __slots__ = ("histogram", "label_values", "start")
+    
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.start = 0.0
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        self.histogram.observe(duration, *self.label_values)
+        
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            trace.add(":".join(map(str, self.label_values)), self.start, duration)
+        return False
+
+
+class Collected:
+    """
+    Метрика, которая считается только при запросе /metrics
+    
+    collect() возвращает {значения меток: число}; так очереди и кэши
+    не тратят ни такта на горячем пути — их stats() читаются при сборе.
+    """
+    
+    def __init__(self, name: str, description: str, labels: tuple, collect, kind: str = "gauge"):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.collect = collect
+        self.kind = kind
+    
+    def samples(self):
+        for label_values, value in self.collect().items():
+            yield self.name, _labels(self.labels, label_values), value
+
+
+class Registry:
+    """Набор метрик процесса и вывод в текстовом формате Prometheus"""
+    
+    def __init__(self):
+        self._metrics = {}
+    
+    def counter(self, name: str, description: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, description, labels))
+    
+    def histogram(self, name: str, description: str, labels: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, description, labels, buckets))
+    
+    def collected(self, name: str, description: str, labels: tuple, collect, kind: str = "gauge") -> Collected:
+        return self._add(Collected(name, description, labels, collect, kind))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{labels} {value}")
+            except Exception as e:
+                logger.warning(f"⚠️ Метрика {metric.name} не собрана: {e}")
+        lines.append("")
+        return "\n".join(lines)
+    
+    def _add(self, metric):
+        # Повторная регистрация (второй BotHandlers в процессе) заменяет старую
+        self._metrics[metric.name] = metric
+        return metric
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "bot_stage_seconds", "Время этапов обработки сообщения, секунды", ("stage",)
+)
+ERRORS = REGISTRY.counter(
+    "bot_errors_total", "Ошибки по месту и классу исключения", ("stage", "error")
+)
+GEMINI_TOKENS = REGISTRY.counter(
+    "gemini_tokens_total", "Токены Gemini по usage_metadata ответов", ("plan", "kind")
+)
+
+
+def timed(stage: str) -> Timer:
+    """with timed("db_history"): ... — время этапа в bot_stage_seconds"""
+    return STAGE_SECONDS.time(stage)
+
+
+def timed_handler(stage: str):
+    """Декоратор async-обработчика: полное время выполнения в bot_stage_seconds"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage):
+                return await handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_error(stage: str, error: Exception):
+    ERRORS.inc(stage, type(error).__name__)
+
+
+def record_tokens(plan: str, response):
+    """Токены промпта и ответа из usage_metadata"""
+    try:
+        usage = response.usage_metadata
+        prompt, output = usage.prompt_token_count, usage.candidates_token_count
+    except Exception:
+        return  # в ответе нет статистики
+    
+    if prompt:
+        GEMINI_TOKENS.inc(plan, "prompt", amount=prompt)
+    if output:
+        GEMINI_TOKENS.inc(plan, "output", amount=output)
+
+
+def register_bot(handlers):
+    """Метрики очередей и кэшей процесса с BotHandlers (читаются из stats() при сборе)"""
+    gemini = handlers.gemini
+    
+    def gemini_queue():
+        stats = gemini.scheduler.stats()
+        values = {("active", ""): stats['active']}
+        for plan, plan_stats in stats['plans'].items():
+            values[("waiting", plan)] = plan_stats['queued']
+        return values
+    
+    def cache_lookups():
+        values = {}
+        db_stats = handlers.db.get_cache_stats()
+        for cache in ("users", "history"):
+            values[(cache, "hit")] = db_stats[cache]['hits']
+            values[(cache, "miss")] = db_stats[cache]['misses']
+        if handlers.response_cache is not None:
+            stats = handlers.response_cache.stats()
+            values[("response", "hit")] = stats['memory_hits'] + stats['db_hits']
+            values[("response", "miss")] = stats['misses']
+        return values
+    
+    REGISTRY.collected(
+        "bot_gemini_queue", "Запросы к Gemini: выполняются и ждут в очереди (по тарифам)",
+        ("state", "plan"), gemini_queue
+    )
+    REGISTRY.collected(
+        "bot_user_queue", "Пользователи с обновлениями в работе и ожидающие обновления",
+        ("state",), lambda: {(state,): value for state, value in handlers.user_locks.stats().items()}
+    )
+    REGISTRY.collected(
+        "bot_db_write_queue", "Записей в очереди фоновой записи в базу",
+        (), lambda: {(): handlers.db._write_queue.qsize()}
+    )
+    REGISTRY.collected(
+        "bot_cache_lookups_total", "Обращения к кэшам: попадания и промахи",
+        ("cache", "result"), cache_lookups, kind="counter"
+    )
+    REGISTRY.collected(
+        "gemini_rate_factor", "Доля настроенного RPM/TPM, которую сейчас использует ограничитель",
+        (), lambda: {(): gemini.limiter.factor}
+    )
+    REGISTRY.collected(
+        "gemini_rate_limited_total", "Ответов 429 от Gemini",
+        (), lambda: {(): gemini.limiter.rate_limited}, kind="counter"
+    )
+    REGISTRY.collected(
+        "gemini_breaker_open", "Предохранитель Gemini разомкнут (1) или нет (0)",
+        (), lambda: {(): int(gemini.breaker.state != gemini.breaker.CLOSED)}
+    )
+
+
+def register_pool(pool):
+    """Метрики главного процесса в режиме воркеров"""
+    REGISTRY.collected(
+        "bot_worker_dispatched_total", "Обновлений передано воркеру",
+        ("worker",), lambda: {(index,): count for index, count in enumerate(pool.dispatched)}, kind="counter"
+    )
+    REGISTRY.collected(
+        "bot_worker_restarts_total", "Перезапусков воркеров",
+        (), lambda: {(): pool.restarts}, kind="counter"
+    )
+    REGISTRY.collected(
+        "bot_worker_alive", "Воркер работает (1) или нет (0)",
+        ("worker",), lambda: {(index,): int(worker['alive']) for index, worker in enumerate(pool.stats()['workers'])}
+    )
+
+
+async def start_server(host: str, port: int, registry: Registry = REGISTRY):
+    """
+    HTTP-сервер с одним адресом /metrics (asyncio, без зависимостей)
+    
+    Returns:
+        asyncio.Server — закрыть через server.close()
+    """
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            while True:  # заголовки запроса не нужны
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            
+            parts = request.split()
+            if len(parts) >= 2 and parts[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"📈 Метрики: http://{host}:{port}/metrics")
+    return server
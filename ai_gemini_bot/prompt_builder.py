@@ -0,0 +1,172 @@
+# prompt_builder.py - сборка промпта: история в пределах бюджета токенов
+from config import (BOT_PERSONALITY, HISTORY_TOKEN_BUDGET, HISTORY_TURN_MAX_TOKENS, HISTORY_TURN_MIN_TOKENS,
+                    TOKEN_CHARS_PER_TOKEN, TOKEN_CALIBRATION_WEIGHT, SUMMARY_MAX_WORDS)
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRIM_MARKER = "\n…(фрагмент пропущен)…\n"
+
+
+class TokenEstimator:
+    """
+    Быстрая оценка числа токенов по длине текста
+    
+    Сколько символов приходится на токен, уточняется по фактическим
+    prompt_token_count из ответов Gemini (скользящее среднее).
+    """
+    
+    def __init__(self, chars_per_token: float = TOKEN_CHARS_PER_TOKEN,
+                 weight: float = TOKEN_CALIBRATION_WEIGHT):
+        self.chars_per_token = chars_per_token
+        self.weight = weight  # вес нового замера в среднем
+        self.samples = 0
+    
+    def estimate(self, text: str) -> int:
+        """Примерное число токенов в тексте"""
+        return int(len(text) / self.chars_per_token) + 1
+    
+    def chars_for(self, tokens: int) -> int:
+        """Сколько символов примерно помещается в tokens токенов"""
+        return int(tokens * self.chars_per_token)
+    
+    def calibrate(self, chars: int, tokens: int):
+        """Учесть фактическое число токенов для текста длиной chars"""
+        if chars <= 0 or tokens <= 0:
+            return
+        
+        self.chars_per_token += self.weight * (chars / tokens - self.chars_per_token)
+        self.samples += 1
+
+
+class PromptBuilder:
+    """
+    Запрос к Gemini: личность бота (системная инструкция) + история + текущее сообщение
+    
+    История передаётся как отдельные реплики (contents с ролями user/model),
+    а не одной склеенной строкой.
+    
+    История берётся с конца, пока помещается в бюджет токенов тарифа
+    (HISTORY_TOKEN_BUDGET); отдельная слишком длинная реплика (например,
+    вставленный лог) сокращается до HISTORY_TURN_MAX_TOKENS. Реплика, которая
+    не помещается в остаток бюджета, сокращается до этого остатка — так
+    свежий контекст не пропадает из-за одного длинного ответа. Реплика с ролью
+    'summary' в начале истории — краткое содержание старой части диалога:
+    она попадает в промпт всегда и расходует бюджет первой.
+    """
+    
+    def __init__(self, estimator: TokenEstimator = None):
+        self.estimator = estimator or TokenEstimator()
+        self.system_instruction = "\n".join(BOT_PERSONALITY)
+    
+    def select_history(self, history: list = None, plan: str = 'free') -> list:
+        """Реплики истории [(role, content), ...], которые попадут в промпт"""
+        if not history:
+            return []
+        
+        budget = HISTORY_TOKEN_BUDGET.get(plan, HISTORY_TOKEN_BUDGET['free'])
+        summary = []
+        
+        if history[0][0] == 'summary':
+            summary = [history[0]]
+            budget -= self.estimator.estimate(history[0][1])
+            history = history[1:]
+        
+        selected = []
+        
+        for role, content in reversed(history):
+            content = self.trim_turn(content)
+            tokens = self.estimator.estimate(content)
+            if tokens > budget:
+                if budget < HISTORY_TURN_MIN_TOKENS:
+                    break  # более старые реплики без этой потеряют связность
+                content = self.trim_turn(content, budget)
+                tokens = self.estimator.estimate(content)
+            
+            selected.append((role, content))
+            budget -= tokens
+        
+        selected.reverse()
+        return summary + selected
+    
+    def trim_turn(self, content: str, max_tokens: int = HISTORY_TURN_MAX_TOKENS) -> str:
+        """Сократить длинную реплику: начало и конец, середина пропускается"""
+        if self.estimator.estimate(content) <= max_tokens:
+            return content
+        
+        chars = max(2, self.estimator.chars_for(max_tokens) - len(TRIM_MARKER))
+        head = chars * 2 // 3
+        tail = chars - head
+        return f"{content[:head].rstrip()}{TRIM_MARKER}{content[-tail:].lstrip()}"
+    
+    def build(self, message: str, history: list = None, plan: str = 'free') -> list:
+        """
+        Собрать contents для generate_content
+        
+        Подряд идущие реплики одной роли склеиваются, а реплики ассистента
+        в самом начале отбрасываются: Gemini ждёт диалог, начинающийся
+        с пользователя, с чередованием ролей.
+        
+        Returns:
+            list: [{"role": "user" | "model", "parts": [str, ...]}, ...]
+        """
+        contents = []
+        
+        turns = self.select_history(history, plan)
+        turns.append(('user', message))
+        
+        for role, content in turns:
+            if role == 'summary':
+                role, content = 'user', f"Краткое содержание предыдущего разговора:\n{content}"
+            
+            role = 'user' if role == 'user' else 'model'
+            if not contents and role == 'model':
+                continue
+            
+            if contents and contents[-1]['role'] == role:
+                contents[-1]['parts'].append(content)
+            else:
+                contents.append({"role": role, "parts": [content]})
+        
+        return contents
+    
+    def prompt_text(self, contents: list) -> str:
+        """Весь текст запроса вместе с системной инструкцией (для оценки токенов)"""
+        parts = [self.system_instruction]
+        for content in contents:
+            parts.extend(content['parts'])
+        return "\n\n".join(parts)
+    
+    def build_summary(self, previous: str, turns: list) -> str:
+        """Промпт для сжатия старых реплик в краткое содержание"""
+        parts = [
+            "Сожми переписку пользователя с ассистентом в краткое содержание "
+            f"(не больше {SUMMARY_MAX_WORDS} слов): факты о пользователе, его цели, "
+            "договорённости и незакрытые вопросы. Пиши от третьего лица, без вступлений."
+        ]
+        
+        if previous:
+            parts.append(f"Предыдущее краткое содержание:\n{previous}")
+        
+        lines = []
+        for role, content in turns:
+            prefix = "Пользователь" if role == "user" else "Ассистент"
+            lines.append(f"{prefix}: {self.trim_turn(content)}")
+        parts.append("Новые реплики:\n" + "\n\n".join(lines))
+        
+        return "\n\n".join(parts)
+    
+    def report(self, prompt: str, response, plan: str = 'free'):
+        """Записать в лог размер промпта и уточнить оценку по usage_metadata"""
+        estimate = self.estimator.estimate(prompt)
+        
+        try:
+            actual = response.usage_metadata.prompt_token_count
+        except Exception:
+            actual = 0  # в ответе нет статистики
+        
+        if actual:
+            self.estimator.calibrate(len(prompt), actual)
+            logger.info(f"📏 Промпт ({plan}): {actual} токенов (оценка {estimate})")
+        else:
+            logger.info(f"📏 Промпт ({plan}): ~{estimate} токенов")
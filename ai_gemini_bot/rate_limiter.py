@@ -0,0 +1,230 @@
+# rate_limiter.py - ограничение частоты запросов к Gemini и защита от сбоев API
+import asyncio
+import random
+import re
+import time
+from google.api_core import exceptions as google_exceptions
+from config import (GEMINI_RPM, GEMINI_TPM, GEMINI_RATE_BURST, GEMINI_AIMD_INCREASE,
+                    GEMINI_AIMD_DECREASE, GEMINI_AIMD_MIN_FACTOR, GEMINI_RETRY_BASE_DELAY,
+                    GEMINI_RETRY_MAX_DELAY, GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET)
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых имеет смысл повторить запрос
+TRANSIENT_ERRORS = (
+    google_exceptions.ServiceUnavailable,    # 503
+    google_exceptions.InternalServerError,   # 500
+    google_exceptions.GatewayTimeout,        # 504 (в т.ч. DeadlineExceeded)
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+RETRY_IN = re.compile(r'retry in ([\d.]+)\s*s', re.IGNORECASE)
+RETRY_DELAY = re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)')
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    """429: превышен лимит запросов или токенов"""
+    return isinstance(error, google_exceptions.TooManyRequests)  # ResourceExhausted — подкласс
+
+
+def is_transient(error: BaseException) -> bool:
+    """Временный сбой на стороне API (повтор может помочь)"""
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def retry_after_seconds(error: BaseException):
+    """Через сколько секунд API разрешает повторить запрос (None — не сказал)"""
+    # RetryInfo в деталях ошибки
+    for detail in getattr(error, 'details', None) or []:
+        retry_delay = getattr(detail, 'retry_delay', None)
+        if retry_delay is not None and getattr(retry_delay, 'seconds', None) is not None:
+            return retry_delay.seconds + getattr(retry_delay, 'nanos', 0) / 1e9
+    
+    # ... или только в тексте: "Please retry in 27.5s", "retry_delay { seconds: 27 }"
+    text = str(error)
+    for pattern in (RETRY_IN, RETRY_DELAY):
+        match = pattern.search(text)
+        if match:
+            return float(match.group(1))
+    
+    return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """Пауза перед повтором: экспонента со случайным разбросом (full jitter)"""
+    return random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+    
+    def delay(self, amount: float) -> float:
+        """Сколько секунд ждать, пока наберётся amount токенов (0 — уже есть)"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+    
+    def consume(self, amount: float):
+        """Списать токены (баланс может уйти в минус — следующие подождут)"""
+        self._refill()
+        self.tokens -= amount
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class AdaptiveRateLimiter:
+    """
+    Лимит запросов к Gemini на стороне бота: RPM и TPM из config.py
+    
+    Скорость подстраивается по AIMD: каждый успешный запрос понемногу
+    увеличивает её (до настроенного лимита), каждый ответ 429 — уменьшает
+    вдвое. Пока API просит подождать (retry-after), новые запросы не уходят.
+    """
+    
+    def __init__(self, rpm: float = GEMINI_RPM, tpm: float = GEMINI_TPM, burst: float = GEMINI_RATE_BURST):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.factor = 1.0  # доля настроенной скорости, которую сейчас используем
+        self.rate_limited = 0  # полученных ответов 429
+        
+        self.requests = TokenBucket(rpm / 60, max(1.0, rpm * burst))
+        self.tokens = TokenBucket(tpm / 60, max(1.0, tpm * burst))
+        
+        self._blocked_until = 0.0
+        self._lock = None  # создаётся лениво внутри event loop
+    
+    def blocked_for(self) -> float:
+        """Сколько секунд ещё действует запрет API (retry-after)"""
+        return max(0.0, self._blocked_until - time.monotonic())
+    
+    async def acquire(self, tokens: int = 0):
+        """Дождаться разрешения на запрос примерно в tokens токенов"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        
+        # По очереди: кто раньше пришёл, тот раньше и отправит
+        async with self._lock:
+            while True:
+                wait = max(self.blocked_for(), self.requests.delay(1), self.tokens.delay(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+    
+    def record_usage(self, estimated: int, actual: int):
+        """Поправить списание токенов по фактическому расходу из ответа"""
+        if actual:
+            self.tokens.consume(actual - estimated)
+    
+    def on_success(self):
+        """Запрос прошёл — аддитивно возвращаем скорость"""
+        if self.factor < 1.0:
+            self._set_factor(self.factor + GEMINI_AIMD_INCREASE)
+    
+    def on_rate_limited(self, retry_after: float = None):
+        """Ответ 429 — мультипликативно снижаем скорость и ждём, сколько просит API"""
+        self.rate_limited += 1
+        self._set_factor(self.factor * GEMINI_AIMD_DECREASE)
+        
+        # Запас запросов тоже сгорает: API уже сказал «хватит»
+        self.requests.tokens = min(self.requests.tokens, 0.0)
+        
+        if retry_after is not None:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        
+        logger.warning(
+            f"🚦 Gemini: лимит запросов (429), скорость снижена до "
+            f"{self.requests.rate * 60:.1f} запр/мин"
+            + (f", пауза {retry_after:.1f} сек" if retry_after is not None else "")
+        )
+    
+    def stats(self) -> dict:
+        """Текущая скорость и число ответов 429"""
+        return {
+            "rpm": self.requests.rate * 60,
+            "tpm": self.tokens.rate * 60,
+            "factor": self.factor,
+            "rate_limited": self.rate_limited,
+            "blocked_for": self.blocked_for(),
+        }
+    
+    def _set_factor(self, factor: float):
+        self.factor = min(1.0, max(GEMINI_AIMD_MIN_FACTOR, factor))
+        self.requests.rate = self.rpm * self.factor / 60
+        self.tokens.rate = self.tpm * self.factor / 60
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после серии сбоев API перестаём отправлять запросы
+    
+    closed — работаем как обычно; после failure_threshold сбоев подряд — open:
+    запросы сразу отклоняются reset_timeout секунд; затем half_open — пропускаем
+    один пробный запрос: успех закрывает предохранитель, сбой снова открывает.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int = GEMINI_BREAKER_FAILURES, reset_timeout: float = GEMINI_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        
+        self._opened_at = 0.0
+        self._probe_at = None  # когда отправлен пробный запрос
+    
+    def allow(self) -> bool:
+        """Можно ли отправить запрос"""
+        if self.state == self.CLOSED:
+            return True
+        
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_at = None
+        
+        # half_open: только один пробный запрос за раз (если он пропал — через reset_timeout ещё один)
+        now = time.monotonic()
+        if self._probe_at is not None and now - self._probe_at < self.reset_timeout:
+            return False
+        self._probe_at = now
+        return True
+    
+    def record_success(self):
+        """API ответил (пусть даже ошибкой запроса) — он жив"""
+        if self.state != self.CLOSED:
+            logger.info("✅ Gemini снова отвечает, предохранитель закрыт")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_at = None
+    
+    def record_failure(self):
+        """Временный сбой API"""
+        self.failures += 1
+        
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.error(
+                    f"🔌 Gemini недоступен ({self.failures} сбоев подряд), "
+                    f"запросы приостановлены на {self.reset_timeout:.0f} сек"
+                )
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probe_at = None
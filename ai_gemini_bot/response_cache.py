@@ -0,0 +1,61 @@
+# response_cache.py - кэш готовых ответов Gemini (память + SQLite)
+from utils.cache import LRUCache
+from config import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Кэш ответов по ключу запроса
+    
+    Сначала ищет в памяти (LRU + TTL), затем в таблице response_cache,
+    чтобы популярные ответы переживали перезапуск бота.
+    """
+    
+    def __init__(self, db=None, maxsize: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.db = db  # DatabaseService или None — только память
+        self.ttl = ttl
+        self.db_hits = 0
+        self._memory = LRUCache(maxsize, ttl)
+        
+        if self.db is not None:
+            self.db.purge_response_cache()
+    
+    def get(self, key: str):
+        """Ответ по ключу или None"""
+        response = self._memory.get(key)
+        if response is not None:
+            return response
+        
+        if self.db is None:
+            return None
+        
+        response = self.db.get_cached_response(key)
+        if response is not None:
+            self.db_hits += 1
+            self._memory.set(key, response)
+        
+        return response
+    
+    def set(self, key: str, response: str):
+        """Запомнить ответ"""
+        self._memory.set(key, response)
+        
+        if self.db is not None:
+            self.db.save_cached_response(key, response, self.ttl)
+    
+    def stats(self) -> dict:
+        """Статистика попаданий (память + база)"""
+        memory = self._memory.stats()
+        lookups = memory['hits'] + memory['misses']
+        hits = memory['hits'] + self.db_hits
+        
+        return {
+            "size": memory['size'],
+            "memory_hits": memory['hits'],
+            "db_hits": self.db_hits,
+            "misses": lookups - hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
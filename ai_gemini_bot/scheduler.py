@@ -0,0 +1,144 @@
+# scheduler.py - очередь запросов к Gemini с приоритетом тарифов
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from config import GEMINI_MAX_CONCURRENT, SCHEDULER_PLAN_WEIGHTS
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PriorityScheduler:
+    """
+    Планировщик запросов к Gemini: взвешенная справедливая очередь по тарифам
+    
+    Одновременно выполняется не больше max_concurrent запросов. Когда все
+    места заняты, следующее место получает тариф с наименьшим «виртуальным
+    временем»: каждый запуск сдвигает его на 1/вес, поэтому VIP получает
+    места в weights['vip'] раз чаще, чем free, но free не голодает.
+    Внутри тарифа пользователи обслуживаются по кругу — один активный
+    пользователь не может занять всю очередь своего тарифа.
+    Класс 'background' с самым малым весом — для фоновых задач бота.
+    """
+    
+    def __init__(self, max_concurrent: int = GEMINI_MAX_CONCURRENT, weights: dict = None):
+        self.max_concurrent = max_concurrent
+        self.weights = dict(weights or SCHEDULER_PLAN_WEIGHTS)
+        self.active = 0
+        
+        self._waiting = 0
+        self._clock = 0.0  # виртуальное время последнего запуска
+        self._vtime = {plan: 0.0 for plan in self.weights}
+        self._queues = {plan: OrderedDict() for plan in self.weights}  # plan -> user_id -> deque[Future]
+        self._stats = {plan: {"requests": 0, "wait_total": 0.0, "wait_max": 0.0} for plan in self.weights}
+    
+    @asynccontextmanager
+    async def slot(self, plan: str = 'free', user_id: int = None):
+        """Занять место на время запроса: async with scheduler.slot(plan, user_id): ..."""
+        await self.acquire(plan, user_id)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    async def acquire(self, plan: str = 'free', user_id: int = None):
+        """Дождаться своей очереди"""
+        if plan not in self.weights:
+            plan = 'free'
+        
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        
+        # Есть свободное место и никто не ждёт — сразу
+        if self.active < self.max_concurrent and self._waiting == 0:
+            self.active += 1
+            self._record(plan, 0.0)
+            return
+        
+        users = self._queues[plan]
+        if not users:
+            # Тариф простаивал — накопленного «кредита» у него нет
+            self._vtime[plan] = max(self._vtime[plan], self._clock)
+        
+        future = loop.create_future()
+        users.setdefault(user_id, deque()).append(future)
+        self._waiting += 1
+        
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Место уже выдано — возвращаем его следующему
+                self.release()
+            else:
+                self._remove(plan, user_id, future)
+            raise
+        
+        self._record(plan, loop.time() - started)
+    
+    def release(self):
+        """Освободить место"""
+        self.active -= 1
+        self._dispatch()
+    
+    def stats(self) -> dict:
+        """Очередь и время ожидания по тарифам"""
+        plans = {}
+        for plan, stats in self._stats.items():
+            requests = stats['requests']
+            plans[plan] = {
+                "queued": sum(len(futures) for futures in self._queues[plan].values()),
+                "requests": requests,
+                "wait_avg": stats['wait_total'] / requests if requests else 0.0,
+                "wait_max": stats['wait_max'],
+            }
+        
+        return {"active": self.active, "waiting": self._waiting, "plans": plans}
+    
+    def _dispatch(self):
+        """Раздать свободные места ожидающим"""
+        while self.active < self.max_concurrent and self._waiting:
+            plan = min(
+                (plan for plan, users in self._queues.items() if users),
+                key=lambda plan: self._vtime[plan]
+            )
+            users = self._queues[plan]
+            
+            # Следующий пользователь тарифа по кругу
+            user_id, futures = next(iter(users.items()))
+            future = futures.popleft()
+            if futures:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            
+            self._waiting -= 1
+            if future.done():
+                continue  # ожидающего отменили, а его задача ещё не проснулась — место не тратим
+            
+            self._clock = self._vtime[plan]
+            self._vtime[plan] += 1.0 / self.weights[plan]
+            
+            self.active += 1
+            future.set_result(None)
+    
+    def _remove(self, plan: str, user_id: int, future: asyncio.Future):
+        """Убрать отменённый запрос из очереди"""
+        futures = self._queues[plan].get(user_id)
+        if futures is None or future not in futures:
+            return
+        
+        futures.remove(future)
+        if not futures:
+            del self._queues[plan][user_id]
+        self._waiting -= 1
+    
+    def _record(self, plan: str, waited: float):
+        """Учесть время ожидания в очереди"""
+        stats = self._stats[plan]
+        stats['requests'] += 1
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+        
+        if waited > 1.0:
+            logger.info(f"⏳ Запрос ({plan}) ждал в очереди {waited:.1f} сек")
@@ -0,0 +1,253 @@
+# sharding.py - несколько процессов-обработчиков: пользователи делятся между ними по user_id
+import asyncio
+import json
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from telegram import Update
+from config import WORKER_HEARTBEAT_INTERVAL, WORKER_HEARTBEAT_TIMEOUT
+import logging
+
+logger = logging.getLogger(__name__)
+
+_STOP = None  # сигнал воркеру: доработать принятые обновления и выйти
+
+
+def shard_for(update: Update, workers: int) -> int:
+    """Номер воркера для обновления: все обновления одного пользователя — в один процесс"""
+    if update.effective_user is not None:
+        key = update.effective_user.id
+    elif update.effective_chat is not None:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % workers
+
+
+class WorkerPool:
+    """
+    Процессы-обработчики и раздача им обновлений
+    
+    Главный процесс только принимает обновления (polling или webhook) и
+    по user_id кладёт их в очередь одного из воркеров. Каждый воркер —
+    отдельный процесс со своими BotHandlers, GeminiAPI и DatabaseService
+    (общая база SQLite в режиме WAL). Обновления пользователя всегда
+    попадают в один и тот же процесс, поэтому их порядок сохраняется
+    (внутри воркера — UserLocks), а разные пользователи обрабатываются
+    на разных ядрах.
+    
+    Воркер раз в WORKER_HEARTBEAT_INTERVAL отмечается в общей памяти;
+    упавший процесс или молчащий дольше WORKER_HEARTBEAT_TIMEOUT
+    перезапускается. У каждого запуска воркера своя очередь: убитый процесс
+    может оставить блокировку чтения очереди занятой, поэтому старая
+    очередь выбрасывается. Воркер в общей памяти считает, сколько обновлений
+    забрал из очереди; главный процесс хранит отправленные, но ещё не
+    забранные, и при перезапуске отправляет их новому процессу.
+    """
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.restarts = 0
+        self.dispatched = [0] * size  # обновлений отдано каждому воркеру
+        
+        # spawn: воркер не наследует потоки и соединения главного процесса
+        self._context = multiprocessing.get_context("spawn")
+        self._heartbeats = [self._context.Value('d', 0.0, lock=False) for _ in range(size)]
+        self._processes = [None] * size
+        self._queues = [None] * size    # очередь текущего запуска воркера
+        self._received = [None] * size  # сколько обновлений воркер забрал из неё (общая память)
+        self._unacked = [deque() for _ in range(size)]  # отправлены, но ещё не забраны
+        self._acked = [0] * size        # сколько уже убрано из _unacked
+        self._monitor = None
+    
+    def start(self):
+        """Запустить воркеры и наблюдение за ними (внутри event loop)"""
+        for index in range(self.size):
+            self._spawn(index)
+        
+        self._monitor = asyncio.create_task(self._watch())
+        logger.info(f"👷 Запущено воркеров: {self.size}")
+    
+    async def dispatch(self, update: Update, context=None):
+        """Обработчик главного процесса: передать обновление воркеру пользователя"""
+        index = shard_for(update, self.size)
+        self._send(index, update.to_json())
+        self.dispatched[index] += 1
+    
+    def stop(self, timeout: float = 30.0):
+        """Дать воркерам доработать очереди и остановить их"""
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        
+        for updates in self._queues:
+            if updates is not None:
+                updates.put(_STOP)
+        
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"⚠️ Воркер {index} не остановился за {timeout:.0f} с — завершаю принудительно")
+                process.terminate()
+                process.join()
+        
+        logger.info("👷 Воркеры остановлены")
+    
+    def stats(self) -> dict:
+        """Состояние воркеров: жив ли процесс, сколько секунд без отметки, сколько обновлений отдано"""
+        now = time.monotonic()
+        return {
+            "restarts": self.restarts,
+            "workers": [
+                {
+                    "alive": process is not None and process.is_alive(),
+                    "silent": round(now - heartbeat.value, 1),
+                    "dispatched": dispatched,
+                }
+                for process, heartbeat, dispatched in zip(self._processes, self._heartbeats, self.dispatched)
+            ],
+        }
+    
+    def _send(self, index: int, data: str):
+        self._trim(index)
+        self._queues[index].put(data)
+        self._unacked[index].append(data)
+    
+    def _trim(self, index: int):
+        """Забыть обновления, которые воркер уже забрал из очереди"""
+        unacked = self._unacked[index]
+        received = self._received[index].value
+        while self._acked[index] < received and unacked:
+            unacked.popleft()
+            self._acked[index] += 1
+    
+    def _spawn(self, index: int):
+        """Запустить воркер с новой очередью и отдать ему то, что не забрал прежний"""
+        pending = []
+        old = self._queues[index]
+        if old is not None:
+            self._trim(index)
+            pending = list(self._unacked[index])
+            old.cancel_join_thread()  # её больше никто не читает — не ждать её при выходе
+            old.close()
+        
+        self._queues[index] = self._context.Queue()
+        self._received[index] = self._context.Value('q', 0, lock=False)
+        self._unacked[index] = deque()
+        self._acked[index] = 0
+        
+        self._heartbeats[index].value = time.monotonic()  # время на запуск процесса
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.size, self._queues[index], self._received[index], self._heartbeats[index]),
+            name=f"worker-{index}"
+        )
+        process.start()
+        self._processes[index] = process
+        
+        if pending:
+            logger.warning(f"🔁 Воркеру {index} повторно отправлено обновлений: {len(pending)}")
+            for data in pending:
+                self._send(index, data)
+    
+    async def _watch(self):
+        """Перезапуск упавших и зависших воркеров"""
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+            self.check()
+    
+    def check(self):
+        """Проверить воркеры один раз"""
+        now = time.monotonic()
+        
+        for index, process in enumerate(self._processes):
+            silent = now - self._heartbeats[index].value
+            if process.is_alive() and silent <= WORKER_HEARTBEAT_TIMEOUT:
+                continue
+            
+            if process.is_alive():
+                logger.error(f"🧊 Воркер {index} не отвечает {silent:.0f} с — перезапуск")
+                process.kill()
+            else:
+                logger.error(f"💥 Воркер {index} завершился (код {process.exitcode}) — перезапуск")
+            
+            process.join(5)
+            self.restarts += 1
+            self._spawn(index)
+
+
+def _worker_main(index: int, workers: int, updates, received, heartbeat):
+    """Точка входа процесса-воркера"""
+    # Ctrl+C получает вся группа процессов — останавливает воркеры главный процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, workers, updates, received, heartbeat))
+
+
+async def receive_updates(updates, received):
+    """
+    Обновления из очереди воркера (асинхронный генератор)
+    
+    Очередь читается в потоке с таймаутом, а не бесконечным get(): при
+    выходе из воркера поток замечает остановку и завершается, не забрав
+    лишнего обновления. received — счётчик забранных в общей памяти;
+    по нему главный процесс знает, что отдать новому воркеру после сбоя.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = threading.Event()
+    
+    def get():
+        while not stopping.is_set():
+            try:
+                return updates.get(timeout=WORKER_HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                continue
+        return _STOP
+    
+    try:
+        while True:
+            data = await loop.run_in_executor(None, get)
+            if data is _STOP:
+                return
+            received.value += 1
+            yield data
+    finally:
+        stopping.set()
+
+
+async def _run_worker(index: int, workers: int, updates, received, heartbeat):
+    """Цикл воркера: обновления из очереди -> Application.update_queue"""
+    from bot import build_application, start_metrics, enable_profiler_signal  # bot импортирует этот модуль
+    from config import METRICS_PORT
+    from handlers import BotHandlers
+    
+    handlers = BotHandlers(gemini_share=1 / workers)
+    enable_profiler_signal()  # kill -USR1 <pid воркера>
+    app = build_application(handlers)
+    
+    async def beat():
+        while True:
+            heartbeat.value = time.monotonic()
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+    
+    await app.initialize()
+    await app.start()
+    beat_task = asyncio.create_task(beat())
+    metrics_server = await start_metrics(METRICS_PORT + 1 + index)
+    logger.info(f"👷 Воркер {index} запущен")
+    
+    try:
+        async for data in receive_updates(updates, received):
+            await app.update_queue.put(Update.de_json(json.loads(data), app.bot))
+    finally:
+        beat_task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        await app.stop()  # дождаться обновлений, которые уже в работе
+        await app.shutdown()
+        handlers.db.close()
+        logger.info(f"👷 Воркер {index} остановлен")
@@ -0,0 +1,172 @@
+# streaming.py - потоковая отправка ответа с правками сообщения
+import asyncio
+import re
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from utils.chunker import MAX_MESSAGE_LENGTH, StreamChunker
+from utils.formatter import to_markdown_v2
+from metrics import timed, record_error
+from config import STREAM_EDIT_INTERVAL
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Конец предложения или строки — после него уже можно показать первое сообщение
+SENTENCE_END = re.compile(r'[.!?…:](\s|$)|\n')
+
+
+def retry_seconds(error: RetryAfter) -> float:
+    """Сколько секунд Telegram просит подождать"""
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class StreamingReply:
+    """
+    Ответ, который появляется в чате по мере генерации
+    
+    Первое сообщение отправляется, как только готово первое предложение,
+    дальше оно редактируется не чаще раза в STREAM_EDIT_INTERVAL секунд.
+    Когда текст перестаёт помещаться в одно сообщение, оно дописывается
+    до конца и продолжение уходит новым сообщением (границы — StreamChunker:
+    блоки кода и inline-разметка не разрываются).
+    
+    Ошибки Telegram ответ не прерывают: неудачная промежуточная правка
+    пропускается, а если не дошла готовая часть, она и всё, что придёт
+    после, копятся в undelivered — их досылает вызывающий код.
+    """
+    
+    def __init__(self, message, edit_interval: float = STREAM_EDIT_INTERVAL,
+                 max_length: int = MAX_MESSAGE_LENGTH):
+        self.message = message  # сообщение пользователя, на которое отвечаем
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        
+        self.pieces = []   # весь полученный текст
+        self.sent = []     # отправленные сообщения Telegram
+        self.undelivered = []  # готовые части, которые не удалось отправить
+        self.chunker = StreamChunker(max_length)
+        
+        self._message = None  # открытое сообщение, которое редактируем
+        self._shown = ""      # что сейчас видит пользователь в открытом сообщении
+        self._next_edit = 0.0
+    
+    @property
+    def text(self) -> str:
+        """Полный текст ответа"""
+        return "".join(self.pieces).strip()
+    
+    async def feed(self, piece: str):
+        """Добавить очередной кусок ответа"""
+        self.pieces.append(piece)
+        
+        # Не помещается в одно сообщение — закрываем его и начинаем новое
+        for chunk in self.chunker.feed(piece):
+            await self._finalize(chunk)
+        
+        if self.undelivered:
+            return  # доставка оборвалась — дальше только собираем текст
+        
+        if self._message is None:
+            # Первое сообщение — как только закончилось первое предложение
+            current = self.chunker.pending
+            if SENTENCE_END.search(current):
+                await self._update(current)
+        
+        elif asyncio.get_running_loop().time() >= self._next_edit:
+            await self._update(self.chunker.pending)
+    
+    async def finish(self) -> str:
+        """
+        Дописать последнее сообщение с форматированием MarkdownV2
+        
+        Returns:
+            str: полный текст ответа
+        """
+        for chunk in self.chunker.finish():
+            await self._finalize(chunk)
+        
+        return self.text
+    
+    async def _update(self, text: str):
+        """Промежуточная правка: обычный текст, без разметки"""
+        text = text.strip()
+        if not text or text == self._shown:
+            return
+        
+        try:
+            await self._send_or_edit(text, parse_mode=None)
+        except RetryAfter as e:
+            # Слишком часто правим — пропускаем правку, покажем позже
+            self._next_edit = asyncio.get_running_loop().time() + retry_seconds(e)
+            return
+        except TelegramError as e:
+            # Промежуточная правка — косметика, ответ из-за неё не прерываем
+            logger.warning(f"⚠️ Не удалось обновить сообщение: {e}")
+            return
+        
+        self._shown = text
+        self._next_edit = asyncio.get_running_loop().time() + self.edit_interval
+    
+    async def _finalize(self, text: str):
+        """Закрыть сообщение с готовой частью; не дошла — часть остаётся в undelivered"""
+        text = text.strip()
+        if not text:
+            return
+        
+        if self.undelivered:
+            self.undelivered.append(text)
+            return
+        
+        try:
+            await self._deliver(text)
+        except TelegramError as e:
+            record_error("reply", e)
+            logger.warning(f"⚠️ Часть ответа не отправлена: {e}")
+            self.undelivered.append(text)
+        
+        if self._message is not None:
+            self.sent.append(self._message)
+        self._message = None
+        self._shown = ""
+        self._next_edit = 0.0
+    
+    async def _deliver(self, text: str):
+        """Окончательный вид сообщения: MarkdownV2, при ошибке разметки — обычный текст"""
+        with timed("format"):
+            formatted = to_markdown_v2(text)
+        
+        for parse_mode, body in (('MarkdownV2', formatted), (None, text)):
+            try:
+                try:
+                    await self._send_or_edit(body, parse_mode=parse_mode)
+                except RetryAfter as e:
+                    # Последнюю версию терять нельзя — ждём и пробуем ещё раз
+                    await asyncio.sleep(retry_seconds(e))
+                    await self._send_or_edit(body, parse_mode=parse_mode)
+                return
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+                if parse_mode is None:
+                    raise  # не принят и обычный текст — часть уйдёт в undelivered
+                record_error("reply", e)
+                logger.warning(f"⚠️ MarkdownV2 не принят Telegram, отправляю без разметки: {e}")
+    
+    async def _send_or_edit(self, text: str, parse_mode):
+        """Первое сообщение отправляем, дальше — редактируем"""
+        if self._message is None:
+            with timed("reply"):
+                self._message = await self.message.reply_text(
+                    text,
+                    parse_mode=parse_mode,
+                    disable_web_page_preview=True
+                )
+        else:
+            with timed("edit"):
+                await self._message.edit_text(
+                    text,
+                    parse_mode=parse_mode,
+                    disable_web_page_preview=True
+                )
@@ -0,0 +1,92 @@
+# summarizer.py - фоновое сжатие длинных диалогов в краткое содержание
+import asyncio
+from gemini_api import GeminiError
+from utils.cache import LRUCache
+from config import (SUMMARY_TRIGGER_MESSAGES, SUMMARY_KEEP_RECENT, SUMMARY_BATCH,
+                    USER_CACHE_SIZE, HISTORY_CACHE_IDLE_TTL)
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationSummarizer:
+    """
+    Сжатие старой части диалога
+    
+    Когда несжатых сообщений становится больше SUMMARY_TRIGGER_MESSAGES,
+    всё, кроме последних SUMMARY_KEEP_RECENT, сворачивается через Gemini
+    в краткое содержание (таблица conversation_summaries). В промпт идут
+    содержание и свежие реплики, поэтому размер запроса не растёт
+    с длиной переписки.
+    
+    Число несжатых сообщений считается в памяти: обработчик сообщения
+    в базу не ходит. Из базы (в фоновом потоке) оно читается, только
+    когда пользователя нет в счётчике — после запуска или простоя.
+    """
+    
+    def __init__(self, db, gemini):
+        self.db = db
+        self.gemini = gemini
+        self._tasks = {}  # user_id -> asyncio.Task (не больше одного сжатия на пользователя)
+        self._pending = LRUCache(USER_CACHE_SIZE, HISTORY_CACHE_IDLE_TTL)  # user_id -> несжатых сообщений
+    
+    def schedule(self, user_id: int, added: int = 2):
+        """Учесть added новых сообщений и запустить сжатие в фоне, если диалог разросся"""
+        pending = self._pending.peek(user_id)
+        if pending is not None:
+            pending += added
+            self._pending.set(user_id, pending)
+            if pending <= SUMMARY_TRIGGER_MESSAGES:
+                return
+        
+        if user_id in self._tasks:
+            return
+        
+        # Счётчика нет — его восстановит из базы сама фоновая задача
+        task = asyncio.create_task(self._compact(user_id))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda done: self._tasks.pop(user_id, None))
+    
+    def forget(self, user_id: int):
+        """История очищена — несжатых сообщений нет"""
+        self._pending.set(user_id, 0)
+    
+    def _load(self, user_id: int):
+        """Краткое содержание и число несжатых сообщений из базы (в фоновом потоке)"""
+        self.db.flush()  # считаем и сжимаем уже записанные сообщения
+        
+        summary = self.db.get_summary(user_id)
+        after_id = summary['last_message_id'] if summary else None
+        return summary, self.db.count_messages_after(user_id, after_id)
+    
+    async def _compact(self, user_id: int):
+        """Свернуть старые сообщения в краткое содержание"""
+        try:
+            summary, count = await asyncio.to_thread(self._load, user_id)
+            self._pending.set(user_id, count)
+            if count <= SUMMARY_TRIGGER_MESSAGES:
+                return
+            
+            after_id = summary['last_message_id'] if summary else None
+            messages = await asyncio.to_thread(
+                self.db.get_messages_after, user_id, after_id, min(count - SUMMARY_KEEP_RECENT, SUMMARY_BATCH)
+            )
+            if not messages:
+                return
+            
+            text = await self.gemini.summarize(
+                summary['summary'] if summary else None,
+                [(role, content) for _, role, content in messages]
+            )
+            
+            if await asyncio.to_thread(self.db.save_summary, user_id, text, messages[-1][0]):
+                # Сообщения, пришедшие во время сжатия, уже учтены в счётчике
+                current = self._pending.peek(user_id)
+                self._pending.set(user_id, max(0, (count if current is None else current) - len(messages)))
+                logger.info(f"🗜️ Диалог {user_id} сжат: {len(messages)} сообщений -> {len(text)} символов")
+        
+        except GeminiError as e:
+            logger.warning(f"⚠️ Не удалось сжать диалог {user_id}: {e}")
+        
+        except Exception as e:
+            logger.error(f"❌ Ошибка сжатия диалога {user_id}: {e}")
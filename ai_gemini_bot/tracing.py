@@ -0,0 +1,183 @@
+# tracing.py - трассировка отдельных обновлений и сэмплирующий профилировщик
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from config import TRACE_SLOW_SECONDS, PROFILER_INTERVAL, PROFILER_DIR
+import logging
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("trace")  # строки JSON медленных обновлений
+
+# Трасса обновления, которое сейчас обрабатывается в этой задаче asyncio
+CURRENT_TRACE = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """
+    Трасса одного обновления: trace_id и отрезки времени (span) по этапам
+    
+    Отрезки добавляют замеры metrics.timed(): всё, что попадает в метрики,
+    попадает и в трассу текущего обновления.
+    """
+    
+    __slots__ = ("trace_id", "name", "user_id", "started_at", "start", "spans")
+    
+    def __init__(self, name: str, user_id: int = None):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.user_id = user_id
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans = []  # (этап, начало от старта трассы, длительность), секунды
+    
+    def add(self, stage: str, start: float, duration: float):
+        self.spans.append((stage, start - self.start, duration))
+    
+    def to_dict(self, duration: float, error: str = None) -> dict:
+        record = {
+            "trace_id": self.trace_id,
+            "update": self.name,
+            "user_id": self.user_id,
+            "started_at": round(self.started_at, 3),
+            "duration_ms": round(duration * 1000, 1),
+            "spans": [
+                {"stage": stage, "offset_ms": round(offset * 1000, 1), "duration_ms": round(length * 1000, 1)}
+                for stage, offset, length in self.spans
+            ],
+        }
+        if error is not None:
+            record["error"] = error
+        return record
+
+
+def current_trace_id() -> str:
+    """trace_id обновления, которое сейчас обрабатывается (для логов), или пустая строка"""
+    trace = CURRENT_TRACE.get()
+    return trace.trace_id if trace is not None else ""
+
+
+def traced(name: str, slow_seconds: float = TRACE_SLOW_SECONDS):
+    """
+    Декоратор обработчика BotHandlers: своя трасса на каждое обновление
+    
+    Если обработка заняла дольше slow_seconds, трасса целиком пишется
+    в лог "trace" одной строкой JSON.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, update, context):
+            if CURRENT_TRACE.get() is not None:
+                return await handler(self, update, context)  # вызван из другого обработчика
+            
+            user = update.effective_user
+            trace = Trace(name, user.id if user is not None else None)
+            token = CURRENT_TRACE.set(trace)
+            error = None
+            
+            try:
+                return await handler(self, update, context)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                CURRENT_TRACE.reset(token)
+                duration = time.perf_counter() - trace.start
+                if duration >= slow_seconds:
+                    trace_logger.warning(json.dumps(trace.to_dict(duration, error), ensure_ascii=False))
+        
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик: раз в interval секунд снимает стеки всех потоков
+    
+    Работает в отдельном потоке и не трогает профилируемый код, поэтому
+    его можно включать на работающем боте. Результат — файл в формате
+    folded stacks ("поток;функция;функция N"), который понимают
+    flamegraph.pl, speedscope и inferno.
+    """
+    
+    def __init__(self, interval: float = PROFILER_INTERVAL, directory: str = PROFILER_DIR):
+        self.interval = interval
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._running = False
+    
+    @property
+    def running(self) -> bool:
+        return self._running
+    
+    def run(self, seconds: float) -> str:
+        """
+        Снимать стеки seconds секунд (блокирует вызывающий поток)
+        
+        Returns:
+            str: путь к файлу .folded или None, если профилировщик уже работает
+        """
+        with self._lock:
+            if self._running:
+                return None
+            self._running = True
+        
+        try:
+            logger.info(f"🔬 Профилирование на {seconds:g} сек...")
+            stacks = self._sample(seconds)
+            return self._dump(stacks)
+        finally:
+            self._running = False
+    
+    def start(self, seconds: float) -> bool:
+        """Запустить run() в фоновом потоке; False — профилировщик уже работает"""
+        if self._running:
+            return False
+        threading.Thread(target=self.run, args=(seconds,), name="profiler", daemon=True).start()
+        return True
+    
+    def _sample(self, seconds: float) -> Counter:
+        stacks = Counter()
+        own = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                
+                frames.append(names.get(thread_id, str(thread_id)))
+                stacks[";".join(reversed(frames))] += 1
+            
+            time.sleep(self.interval)
+        
+        return stacks
+    
+    def _dump(self, stacks: Counter) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded")
+        
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        
+        logger.info(f"🔬 Профиль сохранён: {path} ({sum(stacks.values())} сэмплов)")
+        return path
+
+
+PROFILER = SamplingProfiler()
@@ -0,0 +1,100 @@
+# user_locks.py - сообщения одного пользователя по очереди, разных — параллельно
+import asyncio
+import functools
+from metrics import timed
+from config import USER_QUEUE_LIMIT
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UserBusy(Exception):
+    """У пользователя уже слишком много необработанных сообщений"""
+    pass
+
+
+class UserLocks:
+    """
+    Очередь обновлений на каждого пользователя
+    
+    Обновления одного пользователя выполняются строго по одному и в порядке
+    поступления (asyncio.Lock будит ожидающих по очереди), поэтому история,
+    лимит и промокоды не гоняются между собой. Разные пользователи не ждут
+    друг друга. Запись о пользователе удаляется, как только его очередь
+    опустела, — память не растёт с числом пользователей.
+    """
+    
+    def __init__(self, max_pending: int = USER_QUEUE_LIMIT):
+        self.max_pending = max_pending  # обновлений на пользователя (выполняется + ждут)
+        self._queues = {}  # user_id -> [asyncio.Lock, сколько обновлений держат или ждут]
+    
+    async def acquire(self, user_id: int):
+        """Дождаться своей очереди; UserBusy — если очередь пользователя уже полна"""
+        entry = self._queues.get(user_id)
+        if entry is None:
+            entry = self._queues[user_id] = [asyncio.Lock(), 0]
+        elif entry[1] >= self.max_pending:
+            raise UserBusy(user_id)
+        
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            # Отмена во время ожидания — место в очереди освобождаем
+            self._leave(user_id, entry)
+            raise
+    
+    def release(self, user_id: int):
+        """Обновление обработано — следующее в очереди пользователя может начинаться"""
+        entry = self._queues[user_id]
+        entry[0].release()
+        self._leave(user_id, entry)
+    
+    def _leave(self, user_id: int, entry: list):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._queues[user_id]  # очередь пуста — запись больше не нужна
+    
+    def pending(self, user_id: int) -> int:
+        """Сколько обновлений пользователя выполняется или ждёт"""
+        entry = self._queues.get(user_id)
+        return entry[1] if entry else 0
+    
+    def stats(self) -> dict:
+        """Сколько пользователей сейчас в работе и сколько обновлений ждёт"""
+        return {
+            "users": len(self._queues),
+            "waiting": sum(count - 1 for _, count in self._queues.values()),
+        }
+
+
+def per_user(handler):
+    """
+    Декоратор обработчика BotHandlers: выполнять его в очереди пользователя
+    
+    Использует self.user_locks. Если очередь полна, сообщение не
+    обрабатывается, пользователь получает просьбу подождать.
+    """
+    @functools.wraps(handler)
+    async def wrapper(self, update, context):
+        user = update.effective_user
+        if user is None:
+            return await handler(self, update, context)
+        
+        try:
+            with timed("user_queue"):
+                await self.user_locks.acquire(user.id)
+        except UserBusy:
+            logger.warning(f"⏳ Очередь пользователя {user.id} переполнена, обновление пропущено")
+            if update.effective_message is not None:
+                await update.effective_message.reply_text(
+                    "⏳ Ещё обрабатываю ваши предыдущие сообщения — подождите немного."
+                )
+            return
+        
+        try:
+            return await handler(self, update, context)
+        finally:
+            self.user_locks.release(user.id)
+    
+    return wrapper
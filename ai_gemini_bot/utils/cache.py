@@ -0,0 +1,193 @@
+# utils/cache.py - кэши в памяти процесса
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class LRUCache:
+    """
+    Ограниченный кэш: вытесняет давно не использованные записи (LRU)
+    и забывает записи старше ttl секунд
+    
+    Потокобезопасный, считает попадания и промахи.
+    """
+    
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        """Значение по ключу (с учётом статистики)"""
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+                return default
+            
+            self.hits += 1
+            return value
+    
+    def peek(self, key):
+        """Значение по ключу без учёта в статистике (None — нет в кэше)"""
+        with self._lock:
+            return self._lookup(key)
+    
+    def set(self, key, value):
+        """Положить значение в кэш"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key):
+        """Удалить значение из кэша"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[1] if entry else None
+    
+    def clear(self):
+        """Очистить кэш"""
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def stats(self) -> dict:
+        """Статистика попаданий"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+    
+    def _lookup(self, key):
+        """Поиск с проверкой срока жизни (вызывать под блокировкой)"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        
+        self._data.move_to_end(key)
+        return value
+
+
+class HistoryCache:
+    """
+    Последние реплики активных диалогов: ограниченный deque на пользователя
+    
+    Пользователи, не писавшие дольше idle_ttl секунд, вытесняются; общий объём
+    текста ограничен max_chars — при превышении вытесняются самые давние диалоги.
+    Реплики хранятся как (id, role, content); id = None, пока запись в базу
+    ещё в очереди.
+    """
+    
+    def __init__(self, maxlen: int, idle_ttl: float = 1800.0, max_chars: int = 20_000_000):
+        self.maxlen = maxlen
+        self.idle_ttl = idle_ttl
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self._chars = 0
+        self._users = OrderedDict()  # user_id -> [deque, chars, last_used]
+        self._lock = threading.Lock()
+    
+    def get(self, user_id: int):
+        """Реплики пользователя (старые -> новые) или None, если диалог не загружен"""
+        with self._lock:
+            self._evict()
+            
+            entry = self._users.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            entry[2] = time.monotonic()
+            self._users.move_to_end(user_id)
+            return list(entry[0])
+    
+    def load(self, user_id: int, turns: list):
+        """Загрузить диалог из базы"""
+        with self._lock:
+            self._remove(user_id)
+            
+            history = deque(turns, maxlen=self.maxlen)
+            chars = sum(len(turn[2]) for turn in history)
+            self._users[user_id] = [history, chars, time.monotonic()]
+            self._chars += chars
+            
+            self._evict()
+    
+    def append(self, user_id: int, turn: tuple):
+        """Добавить реплику, если диалог загружен (иначе он загрузится из базы позже)"""
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return
+            
+            history = entry[0]
+            if len(history) == history.maxlen:
+                removed = len(history[0][2])
+                entry[1] -= removed
+                self._chars -= removed
+            
+            history.append(turn)
+            entry[1] += len(turn[2])
+            entry[2] = time.monotonic()
+            self._chars += len(turn[2])
+            self._users.move_to_end(user_id)
+            
+            self._evict()
+    
+    def drop(self, user_id: int):
+        """Забыть диалог пользователя"""
+        with self._lock:
+            self._remove(user_id)
+    
+    def clear(self):
+        """Забыть все диалоги"""
+        with self._lock:
+            self._users.clear()
+            self._chars = 0
+    
+    def stats(self) -> dict:
+        """Статистика попаданий и занятой памяти"""
+        total = self.hits + self.misses
+        return {
+            "users": len(self._users),
+            "chars": self._chars,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+    
+    def _remove(self, user_id: int):
+        """Удалить диалог (вызывать под блокировкой)"""
+        entry = self._users.pop(user_id, None)
+        if entry is not None:
+            self._chars -= entry[1]
+    
+    def _evict(self):
+        """Вытеснить неактивные диалоги и уложиться в бюджет памяти (под блокировкой)"""
+        idle_before = time.monotonic() - self.idle_ttl
+        
+        while self._users:
+            user_id, (history, chars, last_used) = next(iter(self._users.items()))
+            if last_used >= idle_before and self._chars <= self.max_chars:
+                break
+            
+            self._users.popitem(last=False)
+            self._chars -= chars
@@ -1,15 +1,189 @@
 # utils/chunker.py - разбивка длинных сообщений
 import re
+from bisect import bisect_right
 
 MAX_MESSAGE_LENGTH = 4096  # лимит Telegram
 
+CLOSING_FENCE = "\n```"
+
+# Строка-ограничитель блока кода: ``` и, у открывающей, необязательный язык.
+# Строка вида "```pip install foo``` — и готово." — обычный текст, не блок
+FENCE_LINE = re.compile(r'[ \t]*```([\w+#.-]{0,32})[ \t]*\n?$')
+
+# Inline-разметка, внутри которой резать нельзя: `код`, **жирный**, __подчёркнутый__,
+# [ссылка](url), *курсив*, _курсив_, ~зачёркнутый~
+INLINE_ENTITY = re.compile(
+    r'`[^`\n]+`|\*\*[^*\n]+?\*\*|__[^_\n]+?__|\[[^\]\n]*\]\([^)\n]*\)'
+    r'|\*[^*\n]+?\*|_[^_\n]+?_|~[^~\n]+?~'
+)
+
+# Где лучше резать слишком длинную строку: конец предложения, запятая, пробел
+BREAKS = ('. ', '! ', '? ', '; ', ', ', ' ')
+
+
+class _ChunkBuilder:
+    """
+    Накопитель одной части сообщения (список кусков, без повторных склеек строк)
+    
+    Получает текст строками; помнит, открыт ли блок ``` — если часть
+    заканчивается внутри блока кода, блок закрывается и открывается заново
+    в следующей части.
+    """
+    
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self.parts = []
+        self.size = 0
+        self.fence = None     # строка, открывшая текущий блок кода ("```python\n")
+        self._prefix = 0      # длина повторно открытого блока в начале части
+        self._line_start = True  # следующий кусок начинается с новой строки
+    
+    def add(self, line: str, partial: bool = False):
+        """Добавить строку (partial — начало строки, конец которой ещё не пришёл); отдаёт готовые части"""
+        fence = FENCE_LINE.match(line) if self._line_start and not partial else None
+        # Закрывает блок только голая ```; строка с языком внутри блока — его содержимое
+        is_fence = fence is not None and (self.fence is None or not fence.group(1))
+        self._line_start = line.endswith('\n')
+        
+        if is_fence:
+            # Открывающей строке нужно место и под закрытие блока
+            reserve = 0 if self.fence is not None else len(CLOSING_FENCE)
+            if self.size + len(line) + reserve > self.max_length and self.size > self._prefix:
+                yield from self._emit()
+            
+            self._append(line)
+            if self.fence is None:
+                self.fence = f"```{fence.group(1)}\n"
+            else:
+                self.fence = None
+            return
+        
+        spans = None
+        start = 0
+        
+        while True:
+            room = self.max_length - self.size - self._reserve()
+            if len(line) - start <= room:
+                break
+            
+            if self.size > self._prefix:
+                fresh_room = self.max_length - len(self.fence or "") - self._reserve()
+                if len(line) - start <= fresh_room or room < fresh_room // 4:
+                    # Целиком поместится в новую часть — закрываем текущую
+                    yield from self._emit()
+                    continue
+            
+            # Строка длиннее целой части — режем её, дописывая текущую часть
+            if spans is None:
+                spans = self._entity_spans(line)
+            cut = self._cut_position(line, start, start + max(room, 1), spans)
+            self._append(line[start:cut])
+            yield from self._emit()
+            start = cut
+        
+        self._append(line[start:] if start else line)
+    
+    def finish(self):
+        """Отдать последнюю часть"""
+        yield from self._emit(last=True)
+    
+    @property
+    def text(self) -> str:
+        """Текст незакрытой части"""
+        return "".join(self.parts)
+    
+    def _append(self, text: str):
+        if text:
+            self.parts.append(text)
+            self.size += len(text)
+    
+    def _reserve(self) -> int:
+        """Место под закрытие блока кода в конце части"""
+        return len(CLOSING_FENCE) if self.fence is not None else 0
+    
+    def _emit(self, last: bool = False):
+        text = "".join(self.parts)
+        if self.fence is not None and self.size > self._prefix:
+            text = text.rstrip('\n') + CLOSING_FENCE
+        
+        self.parts = []
+        self.size = 0
+        self._prefix = 0
+        
+        # Продолжение блока кода — в новом блоке с тем же языком
+        if self.fence is not None and not last:
+            self._append(self.fence)
+            self._prefix = self.size
+        
+        text = text.strip()
+        if text:
+            yield text
+    
+    def _entity_spans(self, line: str):
+        """Границы inline-разметки в строке (вне блока кода)"""
+        if self.fence is not None:
+            return [], []
+        
+        starts, ends = [], []
+        for match in INLINE_ENTITY.finditer(line):
+            starts.append(match.start())
+            ends.append(match.end())
+        return starts, ends
+    
+    def _cut_position(self, line: str, lo: int, hi: int, spans) -> int:
+        """Где разрезать line[lo:] не дальше hi: по предложению или пробелу, не внутри разметки"""
+        starts, ends = spans
+        
+        def inside(position):
+            i = bisect_right(starts, position - 1) - 1
+            return i >= 0 and ends[i] > position
+        
+        low = lo + (hi - lo) // 2  # не режем слишком коротко
+        for separator in BREAKS:
+            position = line.rfind(separator, low, hi)
+            while position != -1:
+                cut = position + len(separator)
+                if cut <= hi and not inside(cut):
+                    return cut
+                position = line.rfind(separator, low, position)
+        
+        # Подходящего разделителя нет — режем перед разметкой или, если её не обойти, ровно по лимиту
+        if inside(hi):
+            i = bisect_right(starts, hi - 1) - 1
+            if starts[i] > lo:
+                return starts[i]
+        return hi
+
+
+def iter_chunks(text: str, max_length: int = MAX_MESSAGE_LENGTH):
+    """
+    Разбивка за один проход: отдаёт части не длиннее max_length
+    
+    Режет по строкам (абзацы остаются целыми, пока помещаются), слишком
+    длинные строки — по предложениям и пробелам, не разрывая inline-разметку.
+    Блок ``` не разрывается без нужды; если он сам длиннее части, он
+    закрывается в конце части и открывается заново в следующей.
+    """
+    builder = _ChunkBuilder(max_length)
+    start = 0
+    
+    while True:
+        end = text.find('\n', start)
+        if end == -1:
+            break
+        yield from builder.add(text[start:end + 1])
+        start = end + 1
+    
+    if start < len(text):
+        yield from builder.add(text[start:])
+    
+    yield from builder.finish()
+
 
 def split_message(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
     """
     Разбивает длинное сообщение на части по 4096 символов
     
-    Старается разбивать по параграфам или предложениям
-    
     Args:
         text: текст для разбивки
         max_length: максимальная длина одного сообщения
@@ -20,85 +194,63 @@ def split_message(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
     if len(text) <= max_length:
         return [text]
     
-    chunks = []
-    current_chunk = ""
-    
-    # Разбиваем по параграфам
-    paragraphs = text.split('\n\n')
-    
-    for paragraph in paragraphs:
-        # Если параграф слишком длинный, разбиваем по предложениям
-        if len(paragraph) > max_length:
-            sentences = re.split(r'(?<=[.!?])\s+', paragraph)
-            
-            for sentence in sentences:
-                # Если предложение слишком длинное, режем принудительно
-                if len(sentence) > max_length:
-                    for i in range(0, len(sentence), max_length - 100):
-                        chunk = sentence[i:i + max_length - 100]
-                        chunks.append(chunk)
-                    continue
-                
-                if len(current_chunk) + len(sentence) + 1 <= max_length:
-                    current_chunk += sentence + " "
-                else:
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                    current_chunk = sentence + " "
-        
-        else:
-            # Добавляем параграф целиком
-            if len(current_chunk) + len(paragraph) + 2 <= max_length:
-                current_chunk += paragraph + "\n\n"
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = paragraph + "\n\n"
-    
-    # Добавляем последний chunk
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    return chunks
+    return list(iter_chunks(text, max_length))
 
 
-def split_by_code_blocks(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
+class StreamChunker:
     """
-    Разбивка с учётом блоков кода
+    Разбивка текста, который приходит кусками (потоковый ответ)
     
-    Гарантирует, что блоки кода не будут разорваны
+    feed() отдаёт части, которые уже точно не изменятся; pending — текст
+    открытой части, который ещё дописывается.
     """
-    chunks = []
-    current = ""
-    
-    # Найти все блоки кода
-    code_blocks = re.finditer(r'```[\w]*\n.*?```', text, re.DOTALL)
-    last_end = 0
-    
-    for match in code_blocks:
-        # Текст до блока кода
-        before = text[last_end:match.start()]
-        code_block = match.group()
-        
-        # Если текст + код влезает
-        if len(current + before + code_block) <= max_length:
-            current += before + code_block
-        else:
-            # Сохраняем текущий chunk
-            if current + before:
-                chunks.append((current + before).strip())
-            current = code_block
-        
-        last_end = match.end()
-    
-    # Оставшийся текст
-    remaining = text[last_end:]
-    if len(current + remaining) <= max_length:
-        chunks.append((current + remaining).strip())
-    else:
-        if current:
-            chunks.append(current.strip())
-        if remaining:
-            chunks.extend(split_message(remaining, max_length))
-    
-    return [c for c in chunks if c]
\ No newline at end of file
+    
+    def __init__(self, max_length: int = MAX_MESSAGE_LENGTH):
+        self.max_length = max_length
+        self._builder = _ChunkBuilder(max_length)
+        self._tail = []      # начало строки, конец которой ещё не пришёл
+        self._tail_size = 0
+    
+    @property
+    def pending(self) -> str:
+        """Текст открытой части"""
+        return self._builder.text + "".join(self._tail)
+    
+    def feed(self, piece: str) -> list:
+        """Добавить кусок текста; вернуть готовые части"""
+        chunks = []
+        start = 0
+        
+        while True:
+            end = piece.find('\n', start)
+            if end == -1:
+                break
+            
+            self._tail.append(piece[start:end + 1])
+            chunks.extend(self._builder.add("".join(self._tail)))
+            self._tail = []
+            self._tail_size = 0
+            start = end + 1
+        
+        if start < len(piece):
+            self._tail.append(piece[start:])
+            self._tail_size += len(piece) - start
+        
+        # Очень длинная строка без переноса — не ждём её конца
+        if self._tail_size > self.max_length:
+            chunks.extend(self._builder.add("".join(self._tail), partial=True))
+            self._tail = []
+            self._tail_size = 0
+        
+        return chunks
+    
+    def finish(self) -> list:
+        """Отдать всё, что осталось"""
+        chunks = []
+        if self._tail:
+            chunks.extend(self._builder.add("".join(self._tail)))
+            self._tail = []
+            self._tail_size = 0
+        
+        chunks.extend(self._builder.finish())
+        return chunks
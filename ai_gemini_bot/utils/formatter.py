@@ -1,37 +1,228 @@
 # utils/formatter.py - форматирование текста для Telegram
 import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Спецсимволы MarkdownV2: вне разметки экранируются все, внутри кода — только ` и \,
+# внутри адреса ссылки — ) и \. Обратная косая черта идёт первой: её экранируем раньше остальных
+MARKDOWN_V2_SPECIAL = '\\_*[]()~`>#+-=|{}.!'
+ESCAPE_PAIRS = tuple((char, '\\' + char) for char in MARKDOWN_V2_SPECIAL)
+CODE_ESCAPE_TABLE = str.maketrans({'`': '\\`', '\\': '\\\\'})
+URL_ESCAPE_TABLE = str.maketrans({')': '\\)', '\\': '\\\\'})
+
+# Сущности MarkdownV2, которые открываются и закрываются одним и тем же маркером
+ENTITY_MARKERS = ('*', '_', '__', '~', '||')
+# Вне разметки должны быть экранированы
+RESERVED_CHARS = frozenset(']()>#+-=|{}.!')
+FENCE = '```'
+
+# Inline-разметка ответа Gemini (обычный Markdown)
+_INLINE = (
+    r'(?P<code>`(?P<code_text>[^`\n]+)`)'
+    r'|(?P<bold>\*\*(?=\S)(?P<bold_text>[^\n]+?)(?<=\S)\*\*)'
+    r'|(?P<strike>~~(?=\S)(?P<strike_text>[^\n]+?)(?<=\S)~~)'
+    r'|(?P<italic>\*(?<![\w*]\*)(?=[^\s*])(?P<italic_text>[^*\n]+?)(?<=\S)\*(?!\*))'
+    r'|(?P<underscore>_(?<!\w_)(?=\S)(?P<underscore_text>[^_\n]+?)(?<=\S)_(?!\w))'
+    r'|(?P<link>\[(?P<link_text>[^\]\n]+)\]\((?P<link_url>[^)\s]+)\))'
+)
+
+# Быстрая проверка первого символа: большинство позиций отсеиваются без перебора вариантов
+_START = r'(?=[`*~_\[#+-]|^[ \t])'
+
+INLINE_TOKENS = re.compile(_START + '(?:' + _INLINE + ')')
+
+# Разметка уровня строк + inline, всё одним регулярным выражением — один проход по тексту
+TOKENS = re.compile(
+    _START + '(?:'
+    r'(?P<fence>^[ \t]*```(?P<language>[^\n`]*)\n(?P<fence_body>.*?)(?:^[ \t]*```[ \t]*$|\Z))'
+    r'|(?P<heading>^#{1,6}[ \t]+(?P<heading_text>[^\n]+))'
+    r'|(?P<bullet>^(?P<indent>[ \t]*)[*+-][ \t]+)'
+    r'|' + _INLINE + ')',
+    re.MULTILINE | re.DOTALL
+)
 
 
 def format_code(text: str) -> str:
     """
-    Форматирование блоков кода для Telegram Markdown
+    Ответ модели (обычный Markdown) -> Telegram MarkdownV2
     
-    Преобразует ```язык код``` в правильный формат для Telegram
+    Один проход по тексту: блоки ``` и `код` сохраняются (внутри экранируются
+    только ` и \\), **жирный** -> *жирный*, *курсив* и _курсив_ -> _курсив_,
+    ~~зачёркнутый~~ -> ~зачёркнутый~, заголовки # -> жирный текст,
+    маркеры списков * / - / + -> •, ссылки [текст](url) сохраняются.
+    Всё остальное экранируется, поэтому результат всегда можно отправить
+    с parse_mode='MarkdownV2'.
     """
-    # Замена блоков кода на Telegram формат
-    pattern = r'```(\w+)?\n(.*?)```'
+    return _render(text, TOKENS)
+
+
+def _render(text: str, tokens) -> str:
+    """Разметка -> MarkdownV2; текст между разметкой экранируется"""
+    parts = []
+    position = 0
     
-    def replace_code_block(match):
-        language = match.group(1) or ''
-        code = match.group(2)
-        return f'```{language}\n{code}```'
+    for match in tokens.finditer(text):
+        start = match.start()
+        if start > position:
+            parts.append(escape_markdown(text[position:start]))
+        parts.append(_render_token(match))
+        position = match.end()
     
-    formatted = re.sub(pattern, replace_code_block, text, flags=re.DOTALL)
+    if position < len(text):
+        parts.append(escape_markdown(text[position:]))
     
-    return formatted
+    return "".join(parts)
 
 
-def escape_markdown(text: str) -> str:
+def _render_inline(text: str) -> str:
+    """Содержимое жирного/курсива/ссылки: вложенная inline-разметка"""
+    return _render(text, INLINE_TOKENS)
+
+
+def _render_token(match) -> str:
+    """Один элемент разметки в MarkdownV2 (lastgroup — внешняя группа совпавшей разметки)"""
+    return _RENDERERS[match.lastgroup](match)
+
+
+def _fence(match) -> str:
+    language = re.sub(r'[^\w+#-]', '', match.group('language'))
+    body = match.group('fence_body').rstrip('\n').translate(CODE_ESCAPE_TABLE)
+    return f"```{language}\n{body}\n```"
+
+
+def _link(match) -> str:
+    text = _render_inline(match.group('link_text'))
+    url = match.group('link_url').translate(URL_ESCAPE_TABLE)
+    return f"[{text}]({url})"
+
+
+_RENDERERS = {
+    "fence": _fence,
+    "heading": lambda match: f"*{_render_inline(match.group('heading_text').rstrip('# '))}*",
+    "bullet": lambda match: f"{match.group('indent')}• ",
+    "code": lambda match: f"`{match.group('code_text').translate(CODE_ESCAPE_TABLE)}`",
+    "bold": lambda match: f"*{_render_inline(match.group('bold_text'))}*",
+    "strike": lambda match: f"~{_render_inline(match.group('strike_text'))}~",
+    "italic": lambda match: f"_{_render_inline(match.group('italic_text'))}_",
+    "underscore": lambda match: f"_{_render_inline(match.group('underscore_text'))}_",
+    "link": _link,
+}
+
+
+def to_markdown_v2(text: str) -> str:
     """
-    Экранирование специальных символов Markdown
+    format_code с гарантией: результат проходит проверку markdown_v2_error
     
-    Используется для безопасного вывода текста
+    Если разметка всё же получилась некорректной (например, вложенный курсив
+    или склеившиеся _x__y_), текст отправляется без оформления, но полностью
+    экранированным — Telegram его примет.
     """
-    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+    formatted = format_code(text)
+    error = markdown_v2_error(formatted)
+    if error is None:
+        return formatted
+    
+    logger.warning(f"⚠️ Разметка MarkdownV2 исправлена экранированием: {error}")
+    return escape_markdown(text)
+
+
+def markdown_v2_error(text: str):
+    """
+    Проверка текста по правилам MarkdownV2 Telegram (до отправки)
+    
+    Returns:
+        str | None: описание первой ошибки или None, если текст корректен
+    """
+    stack = []  # открытые сущности: '*', '_', '__', '~', '||', '['
+    position = 0
+    length = len(text)
+    
+    while position < length:
+        char = text[position]
+        
+        if char == '\\':
+            if position + 1 >= length or not '\x01' <= text[position + 1] <= '\x7e':
+                return f"одиночный \\ в позиции {position}"
+            position += 2
+            continue
+        
+        if char == '`':
+            marker = FENCE if text.startswith(FENCE, position) else '`'
+            end = _find_closing(text, marker, position + len(marker))
+            if end == -1:
+                return f"незакрытый {marker} в позиции {position}"
+            position = end + len(marker)
+            continue
+        
+        if char == '_' and text.startswith('__', position):
+            # Telegram жадно читает __ как подчёркивание
+            char = '__'
+        elif char == '|':
+            if not text.startswith('||', position):
+                return f"неэкранированный | в позиции {position}"
+            char = '||'
+        
+        if char in ENTITY_MARKERS:
+            if char not in stack:
+                stack.append(char)
+            elif stack[-1] == char:
+                stack.pop()
+            else:
+                return f"пересекающаяся разметка {char} в позиции {position}"
+            position += len(char)
+            continue
+        
+        if char == '[':
+            stack.append(char)
+        elif char == ']':
+            if not stack or stack[-1] != '[':
+                return f"неэкранированный ] в позиции {position}"
+            stack.pop()
+            if not text.startswith('(', position + 1):
+                return f"ссылка без адреса в позиции {position}"
+            end = _find_closing(text, ')', position + 2)
+            if end == -1:
+                return f"незакрытый адрес ссылки в позиции {position}"
+            position = end
+        elif char in RESERVED_CHARS:
+            return f"неэкранированный {char} в позиции {position}"
+        
+        position += 1
     
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
+    if stack:
+        return f"незакрытая разметка {stack[-1]}"
+    return None
+
+
+def _find_closing(text: str, marker: str, position: int) -> int:
+    """Позиция закрывающего marker; внутри кода и адреса ссылки пропускаются экранированные символы"""
+    length = len(text)
+    
+    while position < length:
+        char = text[position]
+        if char == '\\':
+            position += 2
+            continue
+        if text.startswith(marker, position):
+            return position
+        if char == '`':
+            return -1  # неэкранированный ` внутри кода или адреса
+        position += 1
     
+    return -1
+
+
+def escape_markdown(text: str) -> str:
+    """
+    Экранирование специальных символов MarkdownV2
+    
+    Используется для безопасного вывода текста. Цепочка str.replace: на тексте
+    с кириллицей и эмодзи она в несколько раз быстрее str.translate
+    """
+    for char, escaped in ESCAPE_PAIRS:
+        if char in text:
+            text = text.replace(char, escaped)
     return text
 
 
@@ -63,4 +254,4 @@ def clean_response(text: str) -> str:
     # Замена множественных пустых строк на одну
     text = re.sub(r'\n{3,}', '\n\n', text)
     
-    return text.strip()
\ No newline at end of file
+    return text.strip()
@@ -0,0 +1,89 @@
+# utils/singleflight.py - объединение одинаковых одновременных запросов
+import asyncio
+
+
+class SingleFlight:
+    """
+    Одинаковые запросы, пришедшие одновременно, выполняются один раз
+    
+    Первый вызов с ключом запускает работу, остальные ждут её результат
+    (или её исключение). Отмена одного из ожидающих не отменяет работу
+    для остальных; когда отменены все, работа из do() отменяется тоже —
+    брошенный запрос не тратит лимиты и место в очереди.
+    """
+    
+    def __init__(self):
+        self.shared = 0  # вызовов, получивших чужой результат
+        self._calls = {}  # key -> asyncio.Future
+        self._waiters = {}  # задача из do() -> сколько вызовов её сейчас ждут
+    
+    def __len__(self):
+        return len(self._calls)
+    
+    def get(self, key):
+        """Выполняющийся запрос с этим ключом (Future) или None"""
+        return self._calls.get(key)
+    
+    async def wait(self, future):
+        """Дождаться чужого результата"""
+        self.shared += 1
+        if future in self._waiters:
+            return await self._join(future)
+        return await asyncio.shield(future)
+    
+    async def do(self, key, func):
+        """
+        Выполнить func() один раз на все одновременные вызовы с этим ключом
+        
+        Args:
+            key: ключ запроса
+            func: функция без аргументов, возвращающая корутину
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            return await self.wait(future)
+        
+        task = asyncio.ensure_future(func())
+        self._calls[key] = task
+        self._waiters[task] = 0
+        task.add_done_callback(lambda done: self._done(key, done))
+        
+        return await self._join(task)
+    
+    async def _join(self, task: asyncio.Future):
+        """Ждать задачу из do(); ушёл последний ожидающий — задача отменяется"""
+        self._waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task in self._waiters:
+                self._waiters[task] -= 1
+                if self._waiters[task] == 0 and not task.done():
+                    task.cancel()
+    
+    def begin(self, key) -> asyncio.Future:
+        """Начать запрос вручную (для потоковых ответов); завершить через finish()"""
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        future.add_done_callback(lambda done: self._done(key, done))
+        return future
+    
+    def finish(self, future: asyncio.Future, result=None, error: BaseException = None):
+        """Отдать результат (или ошибку) всем, кто ждёт запрос из begin()"""
+        if future.done():
+            return
+        
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    
+    def _done(self, key, future: asyncio.Future):
+        """Запрос завершён — следующий такой же выполнится заново"""
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        self._waiters.pop(future, None)
+        
+        # Ошибку уже получили ожидающие; если их не осталось — не шуметь в логах
+        if not future.cancelled():
+            future.exception()